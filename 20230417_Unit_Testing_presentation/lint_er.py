@@ -1,11 +1,28 @@
 from pathlib import Path
 import argparse
+import csv
+import json
+import os
 import re
 import logging
-from typing import Literal
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, Literal, NamedTuple, Optional
+
+# scan_dirs is shared with compare_paths and compare_bags at the top of the repo.
+# The repo is appended, not put first, so importing lint_er never shadows
+# a module the importer would otherwise get
+REPO = str(Path(__file__).resolve().parent.parent)
+if REPO not in sys.path:
+    sys.path.append(REPO)
+from scan_dirs import scan_tree
 
 LOGGER = logging.getLogger(__name__)
 
+FINDINGS_SAMPLE = 10
+
 def parse_args() -> argparse.Namespace:
     """Validate and return command-line args"""
 
@@ -25,6 +42,23 @@ def parse_args() -> argparse.Namespace:
                 child_dirs.append(child)
         return child_dirs
 
+    def positive_int(n):
+        try:
+            number = int(n)
+        except ValueError:
+            number = 0
+        if number < 1:
+            raise argparse.ArgumentTypeError(
+                f'{n} is not a positive number'
+            )
+        return number
+
+    def rule_set(p):
+        try:
+            return load_rule_set(Path(p))
+        except (OSError, ValueError) as e:
+            raise argparse.ArgumentTypeError(str(e))
+
     parser = argparse.ArgumentParser()
 
     parser.add_argument(
@@ -40,11 +74,170 @@ def parse_args() -> argparse.Namespace:
         dest='packages',
         action='extend'
     )
+    parser.add_argument(
+        '--jobs',
+        type=positive_int,
+        default=1,
+        help='number of packages to lint at the same time'
+    )
+    parser.add_argument(
+        '--scan_workers',
+        type=positive_int,
+        default=1,
+        help='number of folders of a package to list at the same time; '
+             'raise it for packages on network shares. Default 1'
+    )
+    parser.add_argument(
+        '--cache',
+        type=Path,
+        nargs='?',
+        const=default_cache_path(),
+        help='keep lint results between runs in this file, and skip packages '
+             'unchanged since their last lint. Without a file, '
+             f'{default_cache_path()}. Off by default'
+    )
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='lint every package, without reading or writing the cache, '
+             'even if --cache is given'
+    )
+    parser.add_argument(
+        '--rebuild-cache',
+        action='store_true',
+        help='lint every package and replace everything in the cache; '
+             'uses the default cache file if --cache is not given'
+    )
+    parser.add_argument(
+        '--profile',
+        type=Path,
+        help='write the time and filesystem work of every check on every package '
+             'to this file, as CSV if it ends with .csv and JSON otherwise'
+    )
+    parser.add_argument(
+        '--trace',
+        type=Path,
+        help='write the checks as a Chrome trace-event file, '
+             'to open in chrome://tracing or Perfetto'
+    )
+    parser.add_argument(
+        '--rules',
+        type=rule_set,
+        help='JSON file with the rules to run for this site and their severity, '
+             'see load_rule_set. Default all default rules'
+    )
+    parser.add_argument(
+        '--list_rules',
+        action='store_true',
+        help='list every available rule and exit'
+    )
+    parser.add_argument(
+        '--findings_sample',
+        type=positive_int,
+        default=FINDINGS_SAMPLE,
+        help=f'number of offending paths kept and logged for each failed check; '
+             f'the rest are only counted. Default {FINDINGS_SAMPLE}'
+    )
+    parser.add_argument(
+        '--output',
+        choices=['text', 'jsonl'],
+        default='text',
+        help='jsonl prints one JSON record per package to stdout as soon as it is '
+             'linted, with the summary going to stderr. Default text'
+    )
 
     return parser.parse_args()
 
+# Package index
+class PackageEntry(NamedTuple):
+    """One entry below a package, with its path relative to the package root"""
+    path: str
+    parent: str
+    name: str
+    is_dir: bool
+    is_file: bool
+    size: int
+    mtime: int
+
+def index_package(package: Path,
+                  on_entry: Optional[Callable[[PackageEntry], None]] = None,
+                  scan_workers: int = 1
+                  ) -> list[PackageEntry]:
+    """Walk the package once with scan_tree and record every entry below it.
+    Symlinked folders are listed but not descended into, like Path.rglob.
+    on_entry is called with each entry as soon as it is found.
+    scan_workers folders are listed at the same time, which helps on network shares"""
+    index = []
+
+    def cannot_list(rel_dir, error):
+        if not isinstance(error, PermissionError):
+            raise error
+        LOGGER.warning(f'{package.name}: cannot list {rel_dir or package}')
+
+    for rel_dir, entry in scan_tree(package, scan_workers, stat=True, onerror=cannot_list):
+        rel_path = f'{rel_dir}/{entry.name}' if rel_dir else entry.name
+        is_dir = entry.is_dir()
+        is_file = entry.is_file()
+        stat = entry.stat() if is_file or is_dir else None
+        size = stat.st_size if is_file else 0
+        mtime = stat.st_mtime_ns if stat else 0
+        package_entry = PackageEntry(rel_path, rel_dir, entry.name,
+                                     is_dir, is_file, size, mtime)
+        index.append(package_entry)
+        if on_entry:
+            on_entry(package_entry)
+
+    return index
+
+def in_folder(entry: PackageEntry, folder: str) -> bool:
+    """Entry is anywhere below the named second level folder"""
+    return entry.path.startswith(f'{folder}/')
+
 # Individual validation
-def package_has_valid_name(package: Path) -> bool:
+# Each check takes an optional index so lint_package can walk the package once.
+# Single-check callers can leave it out and the package is indexed on the fly.
+# A check given a Findings adds the paths, relative to the package,
+# that made it fail.
+class Findings(list):
+    """Offending paths of a check, keeping only the first few as a sample
+    but counting all of them, so memory stays flat however many there are.
+    With count_all False, extend stops reading paths once it knows there
+    are more than the sample, so a check can stop early"""
+
+    def __init__(self, limit: int = FINDINGS_SAMPLE, count_all: bool = True):
+        super().__init__()
+        self.limit = limit
+        self.count_all = count_all
+        self.total = 0
+
+    def append(self, path: str) -> None:
+        self.total += 1
+        if len(self) < self.limit:
+            super().append(path)
+
+    def extend(self, paths: Iterable[str]) -> None:
+        for path in paths:
+            self.append(path)
+            if not self.count_all and self.total > self.limit:
+                break
+
+    def describe(self, package: Path) -> str:
+        """The sample as full paths, and how many more were left out"""
+        text = str([package / x for x in self])
+        if self.total > len(self):
+            text += f' and {self.total - len(self)} more' if self.count_all else ' and more'
+        return text
+
+def add_findings(findings: Optional[Findings], paths: Iterable[str]) -> Findings:
+    """Add paths to the given findings, or to a new sample if there are none"""
+    if findings is None:
+        findings = Findings()
+    findings.extend(paths)
+    return findings
+
+def package_has_valid_name(package: Path,
+                           index: Optional[list[PackageEntry]] = None,
+                           findings: Optional[Findings] = None) -> bool:
     """Top level folder name has to conform to M###_(ER|DI|EM)_####"""
     folder_name = package.name
     match = re.fullmatch(r'M\d+_(ER|DI|EM)_\d+', folder_name)
@@ -53,60 +246,86 @@ def package_has_valid_name(package: Path) -> bool:
         return True
     else:
         LOGGER.error(f'{folder_name} does not conform to M###_(ER|DI|EM)_####')
+        add_findings(findings, ['.'])
         return False
 
-def package_has_valid_subfolder_names(package: Path) -> bool:
+def package_has_valid_subfolder_names(package: Path,
+                                      index: Optional[list[PackageEntry]] = None,
+                                      findings: Optional[Findings] = None) -> bool:
     """Second level folders must have objects and metadata folder"""
+    if index is None:
+        index = index_package(package)
     expected = set(['objects', 'metadata'])
-    found = set([x.name for x in package.iterdir()])
+    found = set([x.name for x in index if not x.parent])
 
     if expected == found:
         return True
     else:
         LOGGER.error(f'{package.name} subfolders should have objects and metadata, found {found}')
+        add_findings(findings, sorted(found.symmetric_difference(expected)))
         return False
 
-def objects_folder_has_no_access_folder(package: Path) -> bool:
+def objects_folder_has_no_access_folder(package: Path,
+                                        index: Optional[list[PackageEntry]] = None,
+                                        findings: Optional[Findings] = None) -> bool:
     """An access folder within the objects folder indicates it is an older package,
     and the files within the access folder was created by the Library, and should not be ingested"""
-    access_dir = list(package.rglob('access'))
+    if index is None:
+        index = index_package(package)
+    access_dir = add_findings(findings, (x.path for x in index if x.name == 'access'))
 
     if access_dir:
-        LOGGER.error(f'{package.name} has an access folder in this package: {access_dir}')
+        LOGGER.error(f'{package.name} has an access folder in this package: '
+                     f'{access_dir.describe(package)}')
         return False
     else:
         return True
 
-def metadata_folder_is_flat(package: Path) -> bool:
+def metadata_folder_is_flat(package: Path,
+                            index: Optional[list[PackageEntry]] = None,
+                            findings: Optional[Findings] = None) -> bool:
     """The metadata folder should not have folder structure"""
-    for metadata_path in package.glob('metadata'):
-        md_dir_ls = [x for x in metadata_path.iterdir() if x.is_dir()]
+    if index is None:
+        index = index_package(package)
+    md_dir_ls = [package / x.path for x in index
+                 if x.parent == 'metadata' and x.is_dir]
     if md_dir_ls:
         LOGGER.error(f'{package.name} has unexpected directory: {md_dir_ls}')
+        add_findings(findings, [str(x.relative_to(package)) for x in md_dir_ls])
         return False
     else:
         return True
 
-def metadata_folder_has_one_or_less_file(package: Path) -> bool:
+def metadata_folder_has_one_or_less_file(package: Path,
+                                         index: Optional[list[PackageEntry]] = None,
+                                         findings: Optional[Findings] = None) -> bool:
     """The metadata folder should have zero to one file"""
-    for metadata_path in package.glob('metadata'):
-        md_file_ls = [x for x in metadata_path.iterdir() if x.is_file()]
+    if index is None:
+        index = index_package(package)
+    md_file_ls = [package / x.path for x in index
+                  if x.parent == 'metadata' and x.is_file]
     if len(md_file_ls) > 1:
         LOGGER.warning(f'{package.name} has more than one file in the metadata folder: {md_file_ls}')
+        add_findings(findings, [str(x.relative_to(package)) for x in md_file_ls])
         return False
     else:
         return True
 
-def metadata_file_has_valid_filename(package: Path) -> bool:
+def metadata_file_has_valid_filename(package: Path,
+                                     index: Optional[list[PackageEntry]] = None,
+                                     findings: Optional[Findings] = None) -> bool:
     """FTK metadata CSV name should conform to M###_(ER|DI|EM)_####.(csv|CSV)"""
-    for metadata_path in package.glob('metadata'):
-        md_file_ls = [x for x in metadata_path.iterdir() if x.is_file()]
+    if index is None:
+        index = index_package(package)
+    md_file_ls = [package / x.path for x in index
+                  if x.parent == 'metadata' and x.is_file]
 
     if len(md_file_ls) == 1:
         for file in md_file_ls:
             if re.fullmatch(r'M\d+_(ER|DI|EM)_\d+.(csv|CSV)', file.name):
                 return True
             else:
+                add_findings(findings, [str(file.relative_to(package))])
                 if re.fullmatch(r'M\d+_(ER|DI|EM)_\d+.(tsv|TSV)', file.name):
                     LOGGER.warning(f"{package.name}: The metadata file, {file.name}, is a TSV file.")
                     return False
@@ -126,6 +345,7 @@ def metadata_file_has_valid_filename(package: Path) -> bool:
                 unknown_files.append(file)
 
         if good_tsv or unknown_files:
+            add_findings(findings, [str(x.relative_to(package)) for x in good_tsv + unknown_files])
             if good_tsv:
                 LOGGER.warning(f"{package.name} metadata folder has FTK TSV files")
             if unknown_files:
@@ -134,111 +354,568 @@ def metadata_file_has_valid_filename(package: Path) -> bool:
 
         if any(good_csv):
             LOGGER.warning(f"{package.name}has more than one FTK-exported CSV files")
+            add_findings(findings, [str(x.relative_to(package)) for x in good_csv])
             return False
 
     else:
         LOGGER.warning(f"{package.name} has no files in the metadata folder")
+        add_findings(findings, ['metadata'])
         return False
 
-def objects_folder_has_file(package: Path) -> bool:
+def objects_folder_has_file(package: Path,
+                            index: Optional[list[PackageEntry]] = None,
+                            findings: Optional[Findings] = None) -> bool:
     """The objects folder must have one or more files, which can be in folder(s)"""
-    for objects_path in package.glob('objects'):
-        obj_filepaths = [x for x in objects_path.rglob('*') if x.is_file()]
-
-    if not any(obj_filepaths):
+    if index is None:
+        index = index_package(package)
+    if not any(in_folder(x, 'objects') and x.is_file for x in index):
         LOGGER.error(f"{package.name} objects folder does not have any file")
+        add_findings(findings, ['objects'])
         return False
     return True
 
-def package_has_no_bag(package: Path) -> bool:
+def package_has_no_bag(package: Path,
+                       index: Optional[list[PackageEntry]] = None,
+                       findings: Optional[Findings] = None) -> bool:
     """The whole package should not contain any bag"""
-    if list(package.rglob('bagit.txt')):
+    if index is None:
+        index = index_package(package)
+    bag_files = (x.path for x in index if x.name == 'bagit.txt')
+    if findings is None:
+        has_bag = any(True for _ in bag_files)
+    else:
+        findings.extend(bag_files)
+        has_bag = bool(findings)
+    if has_bag:
         LOGGER.error(f"{package.name} has bag structure")
         return False
     else:
         return True
 
-def package_has_no_hidden_file(package: Path) -> bool:
+def package_has_no_hidden_file(package: Path,
+                               index: Optional[list[PackageEntry]] = None,
+                               findings: Optional[Findings] = None) -> bool:
     """The package should not have any hidden file"""
-    hidden_ls = [h for h in package.rglob('*') if h.name.startswith('.') or
-                 h.name.startswith('Thumbs')]
+    if index is None:
+        index = index_package(package)
+    hidden_ls = add_findings(findings, (h.path for h in index if h.name.startswith('.') or
+                                        h.name.startswith('Thumbs')))
     if hidden_ls:
-        LOGGER.warning(f"{package.name} has hidden files {hidden_ls}")
+        LOGGER.warning(f"{package.name} has hidden files {hidden_ls.describe(package)}")
         return False
     else:
         return True
 
-def package_has_no_zero_bytes_file(package: Path) -> bool:
+def package_has_no_zero_bytes_file(package: Path,
+                                   index: Optional[list[PackageEntry]] = None,
+                                   findings: Optional[Findings] = None) -> bool:
     """The package should not have any zero bytes file"""
-    all_file = [f for f in package.rglob('*') if f.is_file()]
-    zero_bytes_ls = [f for f in all_file if f.stat().st_size == 0]
+    if index is None:
+        index = index_package(package)
+    zero_bytes_ls = add_findings(findings, (f.path for f in index if f.is_file and f.size == 0))
     if zero_bytes_ls:
-        LOGGER.error(f"{package.name} has zero bytes file {zero_bytes_ls}")
+        LOGGER.error(f"{package.name} has zero bytes file {zero_bytes_ls.describe(package)}")
         return False
     else:
         return True
 
+# Per-entry checks
+# Each is called on every entry while the package is walked, and
+# returns True for an entry that breaks the rule
+def file_is_over_100_gb(package: Path, entry: PackageEntry) -> bool:
+    """No single file should be over 100 GB"""
+    return entry.is_file and entry.size > 100 * 1000 ** 3
+
+def path_is_over_255_bytes(package: Path, entry: PackageEntry) -> bool:
+    """Paths, starting from the package folder, should be 255 bytes or less"""
+    return len(f'{package.name}/{entry.path}'.encode('utf-8')) > 255
+
+# Rule registry
+class Rule(NamedTuple):
+    """A lint rule and the result a package gets when it fails the rule.
+    A package hook is a check on the whole package index, an entry hook
+    flags single entries during the shared walk of the package"""
+    name: str
+    severity: Literal['invalid', 'needs review']
+    package_hook: Optional[Callable[[Path, list[PackageEntry], Findings], bool]] = None
+    entry_hook: Optional[Callable[[Path, PackageEntry], bool]] = None
+    default: bool = True
+
+RULES: dict[str, Rule] = {}
+
+def register_rule(rule: Rule) -> Rule:
+    """Make a rule available to check_package and rule set files"""
+    RULES[rule.name] = rule
+    return rule
+
+less_strict_tests = [
+    metadata_folder_has_one_or_less_file,
+    metadata_file_has_valid_filename,
+    package_has_no_hidden_file
+]
+
+for check in less_strict_tests:
+    register_rule(Rule(check.__name__, 'needs review', package_hook=check))
+
+strict_tests = [
+    package_has_valid_name,
+    package_has_valid_subfolder_names,
+    objects_folder_has_no_access_folder,
+    metadata_folder_is_flat,
+    objects_folder_has_file,
+    package_has_no_bag,
+    package_has_no_zero_bytes_file
+]
+
+for check in strict_tests:
+    register_rule(Rule(check.__name__, 'invalid', package_hook=check))
+
+register_rule(Rule('package_has_no_file_over_100_gb', 'invalid',
+                   entry_hook=file_is_over_100_gb, default=False))
+register_rule(Rule('package_has_no_path_over_255_bytes', 'invalid',
+                   entry_hook=path_is_over_255_bytes, default=False))
+
+def resolve_rules(rules: Optional[Iterable] = None) -> list[Rule]:
+    """Rules by name or as Rule objects, or the default rules if none are given"""
+    if rules is None:
+        return [rule for rule in RULES.values() if rule.default]
+    return [RULES[rule] if isinstance(rule, str) else rule for rule in rules]
+
+def load_rule_set(path: Path) -> list[Rule]:
+    """Read a site rule set, a JSON file such as
+    {"rules": ["package_has_valid_name", ...], "severity": {"package_has_no_bag": "needs review"}}
+    Rules left out of "rules" are not run; without "rules", the default rules are used"""
+    config = json.loads(Path(path).read_text())
+    names = config.get('rules', [rule.name for rule in resolve_rules()])
+    severity = config.get('severity', {})
+
+    unknown = [name for name in list(names) + list(severity) if name not in RULES]
+    if unknown:
+        raise ValueError(f'{path} has unknown rules: {unknown}')
+    bad_severity = [x for x in severity.values() if x not in ('invalid', 'needs review')]
+    if bad_severity:
+        raise ValueError(f'{path} has unknown severity: {bad_severity}')
+
+    return [RULES[name]._replace(severity=severity.get(name, RULES[name].severity))
+            for name in names]
+
+# Profiling
+class LintProfile:
+    """Wall time and filesystem work of each check on each package.
+    All filesystem access happens while indexing the package; the checks
+    themselves only go through the entries of the index"""
+
+    def __init__(self):
+        self.records = []
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+
+    def add(self, package: Path, check: str, start: float,
+            entries: int, stat_calls: int = 0, dirs_listed: int = 0) -> None:
+        end = time.perf_counter()
+        record = {
+            'package': package.name,
+            'check': check,
+            'start': start - self.origin,
+            'seconds': end - start,
+            'entries': entries,
+            'stat_calls': stat_calls,
+            'dirs_listed': dirs_listed,
+            'thread': threading.get_ident()
+        }
+        with self.lock:
+            self.records.append(record)
+
+    def add_index(self, package: Path, index: list[PackageEntry], start: float) -> None:
+        self.add(package, 'index_package', start, len(index),
+                 stat_calls=sum(1 for x in index if x.is_file or x.is_dir),
+                 dirs_listed=1 + sum(1 for x in index if x.is_dir))
+
+    def totals(self) -> list[dict]:
+        """Records summed per check, slowest check first"""
+        totals = {}
+        for record in self.records:
+            total = totals.setdefault(record['check'], {
+                'check': record['check'], 'packages': 0, 'seconds': 0.0,
+                'entries': 0, 'stat_calls': 0, 'dirs_listed': 0
+            })
+            total['packages'] += 1
+            for key in ['seconds', 'entries', 'stat_calls', 'dirs_listed']:
+                total[key] += record[key]
+        return sorted(totals.values(), key=lambda x: x['seconds'], reverse=True)
+
+    def write_summary(self, path: Path) -> None:
+        if path.suffix.lower() == '.csv':
+            with open(path, 'w', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=list(self.records[0]) if self.records
+                                        else ['package', 'check'])
+                writer.writeheader()
+                writer.writerows(self.records)
+        else:
+            path.write_text(json.dumps(
+                {'checks': self.totals(), 'records': self.records}, indent=2))
+
+    def write_trace(self, path: Path) -> None:
+        events = [{
+            'name': record['check'],
+            'cat': record['package'],
+            'ph': 'X',
+            'ts': record['start'] * 1e6,
+            'dur': record['seconds'] * 1e6,
+            'pid': os.getpid(),
+            'tid': record['thread'],
+            'args': {k: record[k] for k in ['package', 'entries', 'stat_calls', 'dirs_listed']}
+        } for record in self.records]
+        path.write_text(json.dumps({'traceEvents': events}))
+
 # Aggredated validation
+def check_package(package: Path, index: Optional[list[PackageEntry]] = None,
+                  profile: Optional[LintProfile] = None,
+                  findings: Optional[dict[str, Findings]] = None,
+                  findings_sample: int = FINDINGS_SAMPLE,
+                  rules: Optional[Iterable] = None,
+                  scan_workers: int = 1,
+                  count_findings: bool = True
+                  ) -> tuple[Literal['valid', 'invalid', 'needs review'], list[str]]:
+    """Run all linting tests against a package and return the result
+    with the names of the tests it failed. A findings dict is filled with
+    a sample of the offending paths of each failed test, and their count.
+    Entry rules run during the walk that indexes the package, or over the
+    given index, so extra rules cost no extra filesystem access.
+    scan_workers folders are listed at the same time while indexing.
+    With count_findings False, package checks stop reading offending paths
+    once they have more than the sample to log, and findings only gets the
+    entry rules' paths; for callers that need only the result"""
+    result = 'valid'
+    failed = []
+    active = resolve_rules(rules)
+    entry_rules = [rule for rule in active if rule.entry_hook]
+    rule_findings = {rule.name: Findings(findings_sample, count_findings or not rule.package_hook)
+                     for rule in active}
+
+    def on_entry(entry):
+        for rule in entry_rules:
+            if rule.entry_hook(package, entry):
+                rule_findings[rule.name].append(entry.path)
+
+    if index is None:
+        start = time.perf_counter()
+        if entry_rules:
+            index = index_package(package, on_entry, scan_workers)
+        else:
+            index = index_package(package, scan_workers=scan_workers)
+        if profile:
+            profile.add_index(package, index, start)
+    elif entry_rules:
+        start = time.perf_counter()
+        for entry in index:
+            on_entry(entry)
+        if profile:
+            profile.add(package, 'entry_rules', start, len(index))
+
+    for rule in active:
+        start = time.perf_counter()
+        if rule.package_hook:
+            passed = rule.package_hook(package, index, rule_findings[rule.name])
+        else:
+            passed = not rule_findings[rule.name].total
+            if not passed:
+                LOGGER.log(logging.ERROR if rule.severity == 'invalid' else logging.WARNING,
+                           f'{package.name} fails {rule.name}: '
+                           f'{rule_findings[rule.name].describe(package)}')
+        if profile:
+            profile.add(package, rule.name, start, len(index))
+        if not passed:
+            if rule.severity == 'invalid':
+                result = 'invalid'
+            elif result == 'valid':
+                result = 'needs review'
+            failed.append(rule.name)
+            if findings is not None and (count_findings or not rule.package_hook):
+                findings[rule.name] = rule_findings[rule.name]
+
+    return result, failed
+
 def lint_package(package: Path) -> Literal['valid', 'invalid', 'needs review']:
     """Run all linting tests against a package"""
-    result = 'valid'
+    result, _ = check_package(package, count_findings=False)
+    return result
 
-    less_strict_tests = [
-        metadata_folder_has_one_or_less_file,
-        metadata_file_has_valid_filename,
-        package_has_no_hidden_file
-    ]
-
-    for test in less_strict_tests:
-        if not test(package):
-            result = 'needs review'
-
-    strict_tests = [
-        package_has_valid_name,
-        package_has_valid_subfolder_names,
-        objects_folder_has_no_access_folder,
-        metadata_folder_is_flat,
-        objects_folder_has_file,
-        package_has_no_bag,
-        package_has_no_zero_bytes_file
-    ]
-
-    for test in strict_tests:
-        if not test(package):
-            result = 'invalid'
+# Lint cache
+CACHE_VERSION = 6
+# Bump CACHE_VERSION whenever a test changes, so older verdicts are not reused
+
+class CachedLint(NamedTuple):
+    """A lint result with the fingerprint the package had when it was linted"""
+    fingerprint: str
+    result: Literal['valid', 'invalid', 'needs review']
+    failed: list[str]
+    findings: dict[str, list[str]]
+    finding_counts: dict[str, int]
+
+def default_cache_path() -> Path:
+    cache_home = os.environ.get('XDG_CACHE_HOME') or Path.home().joinpath('.cache')
+    return Path(cache_home).joinpath('lint_er', 'lint_cache.sqlite')
+
+def package_fingerprint(index: list[PackageEntry]) -> str:
+    """A digest of every entry's path, and of its mtime if a folder or
+    its size and mtime if a file. Adding, removing or renaming an entry,
+    or writing to a file, changes it; the digest stays the same size
+    however many files the package has"""
+    import hashlib
+    digest = hashlib.blake2b(digest_size=16)
+    # sorted, as folders may list their entries in another order next time
+    for entry in sorted(index, key=lambda x: x.path):
+        values = entry.mtime if entry.is_dir else f'{entry.size}:{entry.mtime}'
+        digest.update(f'{entry.path}\0{values}\n'.encode('utf-8', 'surrogateescape'))
+    return digest.hexdigest()
+
+class LintCache:
+    """Lint results of packages kept in SQLite between runs, keyed on package path.
+    Rows are read by the lint jobs as each package is linted, so the
+    connection is shared between threads behind a lock"""
+
+    def __init__(self, path: Path, rules: Optional[Iterable] = None):
+        import sqlite3
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # results are only reused for the same rules with the same severity
+        self.rule_set = json.dumps([[rule.name, rule.severity] for rule in resolve_rules(rules)])
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        # a cache written by another version is dropped, as its columns may differ
+        if self.conn.execute('PRAGMA user_version').fetchone()[0] != CACHE_VERSION:
+            with self.conn:
+                self.conn.execute('DROP TABLE IF EXISTS packages')
+                self.conn.execute(f'PRAGMA user_version = {CACHE_VERSION}')
+        self.conn.execute(
+            '''CREATE TABLE IF NOT EXISTS packages (
+                path TEXT PRIMARY KEY,
+                version INTEGER NOT NULL,
+                rule_set TEXT NOT NULL,
+                fingerprint TEXT NOT NULL,
+                result TEXT NOT NULL,
+                failed TEXT NOT NULL,
+                findings TEXT NOT NULL,
+                finding_counts TEXT NOT NULL
+            )'''
+        )
+
+    def get(self, package: Path) -> Optional[CachedLint]:
+        with self.lock:
+            row = self.conn.execute(
+                '''SELECT fingerprint, result, failed, findings, finding_counts
+                   FROM packages WHERE path = ? AND version = ? AND rule_set = ?''',
+                (str(package.resolve()), CACHE_VERSION, self.rule_set)
+            ).fetchone()
+        if not row:
+            return None
+        return CachedLint(row[0], row[1], json.loads(row[2]),
+                          json.loads(row[3]), json.loads(row[4]))
+
+    def put(self, package: Path, cached: CachedLint) -> None:
+        with self.lock, self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO packages VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (str(package.resolve()), CACHE_VERSION, self.rule_set, cached.fingerprint,
+                 cached.result, json.dumps(cached.failed), json.dumps(cached.findings),
+                 json.dumps(cached.finding_counts))
+            )
 
-    return result
+    def clear(self) -> None:
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM packages')
+
+    def close(self) -> None:
+        with self.lock:
+            self.conn.close()
+
+# Multi-package linting
+class PackageLogBuffer(logging.Filter):
+    """Hold back log records emitted on a thread that is linting a package,
+    so they can be released in package order instead of as they happen"""
+
+    def __init__(self):
+        super().__init__()
+        self.local = threading.local()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        records = getattr(self.local, 'records', None)
+        if records is None:
+            return True
+        records.append(record)
+        return False
+
+def counts_of(findings: dict[str, Findings]) -> dict[str, int]:
+    return {check: found.total for check, found in findings.items()}
+
+class PackageLint(NamedTuple):
+    """The lint result of one package, with what it failed and why"""
+    package: Path
+    result: Literal['valid', 'invalid', 'needs review']
+    failed: list[str]
+    findings: dict[str, list[str]]
+    finding_counts: dict[str, int]
+    cached: bool
+
+    def as_record(self) -> dict:
+        return {
+            'package': self.package.name,
+            'path': str(self.package),
+            'result': self.result,
+            'failed': self.failed,
+            'findings': self.findings,
+            'finding_counts': self.finding_counts,
+            'cached': self.cached
+        }
+
+def lint_packages_detailed(packages: Iterable[Path], jobs: int = 1,
+                           cache: Optional[LintCache] = None,
+                           profile: Optional[LintProfile] = None,
+                           findings_sample: int = FINDINGS_SAMPLE,
+                           rules: Optional[Iterable] = None,
+                           scan_workers: int = 1,
+                           count_findings: bool = True
+                           ) -> Iterator[PackageLint]:
+    """Lint packages and yield their results in the order they were given.
+    With more than one job, packages are linted on a thread pool, as the work
+    is mostly waiting on the filesystem. Each package's log lines are still
+    emitted together and in package order, just like a serial run.
+    With a cache, every package is indexed, and one whose entries, file
+    sizes and mtimes are unchanged since its last lint is not checked
+    again; the cached result is used. A package's cached row is only read
+    when that package is linted.
+    With a profile, the time and filesystem work of every check is recorded.
+    rules picks the rules to run, by default all default rules.
+    scan_workers folders of each package are listed at the same time.
+    count_findings False lets checks stop early, as in check_package; it is
+    ignored with a cache, whose results must hold every finding"""
+    packages = list(packages)
+
+    def lint_one(package):
+        findings = {}
+        if cache is None:
+            result, failed = check_package(package, None, profile, findings, findings_sample, rules,
+                                           scan_workers, count_findings)
+            return PackageLint(package, result, failed, findings, counts_of(findings), False), None
+        # the index is needed for the fingerprint, and is reused by the checks if it changed
+        start = time.perf_counter()
+        index = index_package(package, scan_workers=scan_workers)
+        if profile:
+            profile.add_index(package, index, start)
+        fingerprint = package_fingerprint(index)
+        cached = cache.get(package)
+        if cached and cached.fingerprint == fingerprint:
+            LOGGER.info(f'{package.name} is unchanged since it was last linted')
+            if cached.failed:
+                LOGGER.warning(f'{package.name} failed {", ".join(cached.failed)} when last linted')
+            return PackageLint(package, cached.result, cached.failed, cached.findings,
+                               cached.finding_counts, True), None
+        result, failed = check_package(package, index, profile, findings, findings_sample, rules)
+        fresh = CachedLint(fingerprint, result, failed, findings, counts_of(findings))
+        return PackageLint(package, result, failed, findings, counts_of(findings), False), fresh
+
+    def save(package, fresh):
+        if cache and fresh:
+            cache.put(package, fresh)
+
+    if jobs <= 1:
+        for package in packages:
+            lint, fresh = lint_one(package)
+            save(package, fresh)
+            yield lint
+        return
+
+    log_buffer = PackageLogBuffer()
+
+    def lint_buffered(package):
+        log_buffer.local.records = []
+        try:
+            return lint_one(package), log_buffer.local.records
+        finally:
+            log_buffer.local.records = None
+
+    LOGGER.addFilter(log_buffer)
+    try:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            results = executor.map(lint_buffered, packages)
+            for package, ((lint, fresh), records) in zip(packages, results):
+                for record in records:
+                    LOGGER.handle(record)
+                save(package, fresh)
+                yield lint
+    finally:
+        LOGGER.removeFilter(log_buffer)
+
+def lint_packages(packages: Iterable[Path], jobs: int = 1,
+                  cache: Optional[LintCache] = None,
+                  profile: Optional[LintProfile] = None,
+                  rules: Optional[Iterable] = None
+                  ) -> Iterator[tuple[Path, Literal['valid', 'invalid', 'needs review']]]:
+    """Lint packages like lint_packages_detailed, yielding only package and result"""
+    for lint in lint_packages_detailed(packages, jobs, cache, profile, rules=rules):
+        yield lint.package, lint.result
 
 def main():
     args = parse_args()
 
+    if args.list_rules:
+        for rule in RULES.values():
+            default = '' if rule.default else ' (not run by default)'
+            print(f'{rule.name}: {rule.severity}{default}')
+        return
+
     valid = []
     invalid = []
     needs_review = []
 
     counter = 0
 
-    for package in args.packages:
-        counter += 1
-        result = lint_package(package)
-        if result == 'valid':
-            valid.append(package.name)
-        elif result == 'invalid':
-            invalid.append(package.name)
-        else:
-            needs_review.append(package.name)
-    print(f'\nTotal packages ran: {counter}')
+    cache = None
+    if (args.cache or args.rebuild_cache) and not args.no_cache:
+        cache = LintCache(args.cache or default_cache_path(), args.rules)
+        if args.rebuild_cache:
+            cache.clear()
+
+    profile = LintProfile() if args.profile or args.trace else None
+
+    try:
+        # only jsonl records show findings
+        for lint in lint_packages_detailed(args.packages, args.jobs, cache, profile,
+                                           args.findings_sample, args.rules,
+                                           args.scan_workers, args.output == 'jsonl'):
+            package, result = lint.package, lint.result
+            if args.output == 'jsonl':
+                print(json.dumps(lint.as_record()), flush=True)
+            counter += 1
+            if result == 'valid':
+                valid.append(package.name)
+            elif result == 'invalid':
+                invalid.append(package.name)
+            else:
+                needs_review.append(package.name)
+    finally:
+        if cache:
+            cache.close()
+
+    if args.profile:
+        profile.write_summary(args.profile)
+    if args.trace:
+        profile.write_trace(args.trace)
+
+    # with jsonl, stdout only carries the records
+    summary = sys.stderr if args.output == 'jsonl' else sys.stdout
+    print(f'\nTotal packages ran: {counter}', file=summary)
     if valid:
         print(f'''
         The following {len(valid)} packages are valid:
-        {", ".join(str(x) for x in valid)}''')
+        {", ".join(str(x) for x in valid)}''', file=summary)
     if invalid:
         print(f'''
-        The following {len(invalid)} packages are invalid: {invalid}''')
+        The following {len(invalid)} packages are invalid: {invalid}''', file=summary)
     if needs_review:
         print(f'''
         The following {len(needs_review)} packages need review.
-        They may be passed without change after review: {needs_review}''')
+        They may be passed without change after review: {needs_review}''', file=summary)
 
 if __name__=='__main__':
     main()
@@ -1,4 +1,7 @@
 import lint_er as lint_er
+import os
+import re
+import json
 import pytest
 from pathlib import Path
 
@@ -8,6 +11,13 @@ presentation, I am skipping it in this script. Please see the official script
 https://github.com/NYPL/prsv-tools/blob/main/tests/test_lint_er.py
 """
 
+@pytest.fixture(autouse=True)
+def cache_home(tmp_path_factory, monkeypatch):
+    """Keep the lint cache of script runs out of the real home folder"""
+    cache_home = tmp_path_factory.mktemp('cache')
+    monkeypatch.setenv('XDG_CACHE_HOME', str(cache_home))
+    return cache_home
+
 @pytest.fixture
 def good_package(tmp_path: Path):
     pkg = tmp_path.joinpath('M12345_ER_0001')
@@ -27,6 +37,51 @@ def good_package(tmp_path: Path):
     return pkg
 
 # Unit tests
+def test_index_package(good_package):
+    """The package index lists every entry once, relative to the package root"""
+    index = lint_er.index_package(good_package)
+
+    assert sorted(x.path for x in index) == [
+        'metadata', 'metadata/M12345_ER_0001.csv',
+        'objects', 'objects/randomFile.txt'
+    ]
+    csv_entry = [x for x in index if x.name == 'M12345_ER_0001.csv'][0]
+    assert csv_entry.parent == 'metadata'
+    assert csv_entry.is_file and not csv_entry.is_dir
+    assert csv_entry.size == len(b'some bytes for metadata')
+
+def test_index_package_scan_workers(good_package):
+    """Listing folders concurrently indexes the same entries in the same order"""
+    for i in range(20):
+        folder = good_package.joinpath('objects', f'folder{i}', 'sub')
+        folder.mkdir(parents=True)
+        folder.joinpath('file.txt').write_bytes(b'x')
+
+    assert lint_er.index_package(good_package, scan_workers=4) == \
+        lint_er.index_package(good_package)
+
+def test_checks_use_given_index(good_package):
+    """Checks evaluate against a prebuilt index instead of the disk"""
+    index = lint_er.index_package(good_package)
+    good_package.joinpath('objects').joinpath('.DS_Store').touch()
+
+    assert lint_er.package_has_no_hidden_file(good_package, index) == True
+    assert lint_er.package_has_no_hidden_file(good_package) == False
+
+def test_lint_package_walks_once(monkeypatch, good_package):
+    """lint_package indexes the package once and shares it with every check"""
+    calls = []
+    index_package = lint_er.index_package
+
+    def counting_index(package, **kwargs):
+        calls.append(package)
+        return index_package(package, **kwargs)
+
+    monkeypatch.setattr(lint_er, 'index_package', counting_index)
+    lint_er.lint_package(good_package)
+
+    assert calls == [good_package]
+
 def test_top_folder_valid_name(good_package):
     """Top level folder name has to conform to M###_(ER|DI|EM)_####"""
     result = lint_er.package_has_valid_name(good_package)
@@ -320,4 +375,399 @@ def test_lint_invalid_package(monkeypatch, good_package, capsys):
 
     stdout = capsys.readouterr().out
 
-    assert f'packages are invalid:' in stdout
\ No newline at end of file
+    assert f'packages are invalid:' in stdout
+
+
+@pytest.fixture
+def mixed_packages(good_package):
+    """A directory of packages with valid, invalid and needs review results"""
+    parent = good_package.parent
+    for n in range(2, 8):
+        pkg = parent.joinpath(f'M12345_ER_000{n}')
+        pkg.joinpath('objects').mkdir(parents=True)
+        pkg.joinpath('objects').joinpath('randomFile.txt').write_bytes(b'object')
+        pkg.joinpath('metadata').mkdir()
+        pkg.joinpath('metadata').joinpath(f'M12345_ER_000{n}.csv').write_bytes(b'md')
+        if n % 3 == 0:
+            pkg.joinpath('objects').joinpath('zerobytes.txt').touch()
+        elif n % 3 == 1:
+            pkg.joinpath('objects').joinpath('.DS_Store').write_bytes(b'ds')
+    return parent
+
+def test_lint_packages_parallel_keeps_order(mixed_packages, caplog):
+    """Parallel linting yields results and log lines in package order"""
+    packages = sorted(mixed_packages.iterdir())
+
+    serial = list(lint_er.lint_packages(packages))
+    serial_logs = [r.getMessage() for r in caplog.records]
+    caplog.clear()
+    parallel = list(lint_er.lint_packages(packages, jobs=4))
+    parallel_logs = [r.getMessage() for r in caplog.records]
+
+    assert parallel == serial
+    assert parallel_logs == serial_logs
+
+def test_lint_directory_jobs_matches_serial(monkeypatch, mixed_packages, capsys):
+    """Run entire script with --jobs and get the same summary as a serial run"""
+    monkeypatch.setattr(
+        'sys.argv', [
+            '../bin/lint_er.py',
+            '--directory', str(mixed_packages)
+        ]
+    )
+    lint_er.main()
+    serial_stdout = capsys.readouterr().out
+
+    monkeypatch.setattr(
+        'sys.argv', [
+            '../bin/lint_er.py',
+            '--directory', str(mixed_packages),
+            '--jobs', '4'
+        ]
+    )
+    lint_er.main()
+    parallel_stdout = capsys.readouterr().out
+
+    assert 'packages need review' in serial_stdout
+    assert parallel_stdout == serial_stdout
+
+def count_checks(monkeypatch):
+    """Record every package that check_package actually lints"""
+    checked = []
+    check_package = lint_er.check_package
+
+    def counting_check(package, *args, **kwargs):
+        checked.append(package.name)
+        return check_package(package, *args, **kwargs)
+
+    monkeypatch.setattr(lint_er, 'check_package', counting_check)
+    return checked
+
+def test_cache_skips_unchanged_package(monkeypatch, tmp_path, good_package):
+    """A package is linted once and then answered from the cache"""
+    checked = count_checks(monkeypatch)
+    cache = lint_er.LintCache(tmp_path / 'cache.sqlite')
+
+    first = list(lint_er.lint_packages([good_package], cache=cache))
+    second = list(lint_er.lint_packages([good_package], cache=cache))
+
+    assert first == second == [(good_package, 'valid')]
+    assert checked == ['M12345_ER_0001']
+
+def test_cache_relints_changed_package(monkeypatch, tmp_path, good_package):
+    """Adding a file to a package folder invalidates its cached result"""
+    checked = count_checks(monkeypatch)
+    cache = lint_er.LintCache(tmp_path / 'cache.sqlite')
+
+    list(lint_er.lint_packages([good_package], cache=cache))
+    folder = good_package.joinpath('objects').joinpath('folder')
+    folder.mkdir()
+    list(lint_er.lint_packages([good_package], cache=cache))
+    folder.joinpath('.DS_Store').write_bytes(b'ds')
+    result = list(lint_er.lint_packages([good_package], cache=cache))
+
+    assert result == [(good_package, 'needs review')]
+    assert len(checked) == 3
+    assert cache.get(good_package).failed == ['package_has_no_hidden_file']
+
+def test_cache_keeps_compact_fingerprint(tmp_path, good_package):
+    """The cache keeps one short digest per package, however many files it has"""
+    for n in range(200):
+        good_package.joinpath('objects').joinpath(f'file{n}.txt').write_bytes(b'x')
+    cache = lint_er.LintCache(tmp_path / 'cache.sqlite')
+
+    list(lint_er.lint_packages([good_package], cache=cache))
+
+    assert len(cache.get(good_package).fingerprint) == 32
+
+def test_cache_read_as_packages_are_linted(monkeypatch, tmp_path, mixed_packages):
+    """Each package's cached row is read by the job linting it, not all up front"""
+    packages = sorted(mixed_packages.iterdir())
+    cache = lint_er.LintCache(tmp_path / 'cache.sqlite')
+    list(lint_er.lint_packages(packages, cache=cache))
+    read = []
+    get = cache.get
+    monkeypatch.setattr(cache, 'get', lambda package: read.append(package.name) or get(package))
+
+    lints = lint_er.lint_packages_detailed(packages, cache=cache)
+    next(lints)
+    assert read == [packages[0].name]
+    list(lints)
+    parallel = list(lint_er.lint_packages_detailed(packages, jobs=2, cache=cache))
+
+    assert sorted(read) == sorted([x.name for x in packages] * 2)
+    assert all(lint.cached for lint in parallel)
+
+def test_cache_relints_file_written_in_place(monkeypatch, tmp_path, good_package):
+    """Writing to a file changes its size and mtime, though not its folder's"""
+    checked = count_checks(monkeypatch)
+    cache = lint_er.LintCache(tmp_path / 'cache.sqlite')
+    empty = good_package.joinpath('objects').joinpath('f.txt')
+    empty.touch()
+
+    first = list(lint_er.lint_packages([good_package], cache=cache))
+    folder_mtime = os.stat(empty.parent).st_mtime_ns
+    empty.write_bytes(b'data')
+    os.utime(empty.parent, ns=(folder_mtime, folder_mtime))
+    second = list(lint_er.lint_packages([good_package], cache=cache))
+
+    assert first == [(good_package, 'invalid')]
+    assert second == [(good_package, 'valid')]
+    assert len(checked) == 2
+
+def test_lint_default_run_has_no_cache(monkeypatch, good_package, cache_home):
+    """Without --cache, the script neither writes nor reads a cache"""
+    checked = count_checks(monkeypatch)
+    monkeypatch.setattr('sys.argv', ['../bin/lint_er.py', '--package', str(good_package)])
+    lint_er.main()
+    lint_er.main()
+
+    assert not cache_home.joinpath('lint_er').exists()
+    assert checked == ['M12345_ER_0001', 'M12345_ER_0001']
+
+def test_lint_no_cache(monkeypatch, good_package, cache_home):
+    """Run entire script with --no-cache, which leaves no cache file"""
+    monkeypatch.setattr(
+        'sys.argv', [
+            '../bin/lint_er.py',
+            '--package', str(good_package),
+            '--no-cache'
+        ]
+    )
+    lint_er.main()
+
+    assert not cache_home.joinpath('lint_er').exists()
+
+def test_lint_rebuild_cache(monkeypatch, good_package, cache_home):
+    """Run entire script with --rebuild-cache, which lints cached packages again"""
+    checked = count_checks(monkeypatch)
+    argv = ['../bin/lint_er.py', '--package', str(good_package)]
+
+    monkeypatch.setattr('sys.argv', argv + ['--cache'])
+    lint_er.main()
+    lint_er.main()
+    monkeypatch.setattr('sys.argv', argv + ['--rebuild-cache'])
+    lint_er.main()
+
+    assert cache_home.joinpath('lint_er', 'lint_cache.sqlite').is_file()
+    assert checked == ['M12345_ER_0001', 'M12345_ER_0001']
+
+def test_profile_records_every_check(good_package):
+    """A profile gets one record for indexing and one for each check"""
+    profile = lint_er.LintProfile()
+
+    lint_er.check_package(good_package, profile=profile)
+
+    checks = [x['check'] for x in profile.records]
+    assert checks[0] == 'index_package'
+    assert len(checks) == 11
+    assert profile.records[0]['entries'] == 4
+    assert profile.records[0]['dirs_listed'] == 3
+    assert {x['check'] for x in profile.totals()} == set(checks)
+
+def test_lint_profile_and_trace(monkeypatch, tmp_path, good_package):
+    """Run entire script with --profile and --trace"""
+    summary = tmp_path / 'profile.json'
+    trace = tmp_path / 'trace.json'
+    monkeypatch.setattr(
+        'sys.argv', [
+            '../bin/lint_er.py',
+            '--package', str(good_package),
+            '--no-cache',
+            '--profile', str(summary),
+            '--trace', str(trace)
+        ]
+    )
+
+    lint_er.main()
+
+    assert len(json.loads(summary.read_text())['records']) == 11
+    events = json.loads(trace.read_text())['traceEvents']
+    assert {x['ph'] for x in events} == {'X'}
+    assert events[0]['args']['package'] == 'M12345_ER_0001'
+
+def test_check_package_findings(good_package):
+    """Failed checks report the offending paths relative to the package"""
+    good_package.joinpath('objects').joinpath('.DS_Store').write_bytes(b'ds')
+    good_package.joinpath('objects').joinpath('zerobytes.txt').touch()
+    findings = {}
+
+    result, failed = lint_er.check_package(good_package, findings=findings)
+
+    assert result == 'invalid'
+    assert failed == ['package_has_no_hidden_file', 'package_has_no_zero_bytes_file']
+    assert findings == {
+        'package_has_no_hidden_file': ['objects/.DS_Store'],
+        'package_has_no_zero_bytes_file': ['objects/zerobytes.txt']
+    }
+
+class CountingIndex(list):
+    """A package index that counts the entries read from it"""
+    read = 0
+
+    def __iter__(self):
+        for entry in super().__iter__():
+            self.read += 1
+            yield entry
+
+def test_check_package_result_only(monkeypatch, good_package):
+    """Without findings to count, package checks get findings that stop
+    reading paths past the sample, and the result is the same"""
+    for n in range(3):
+        bag = good_package.joinpath('objects', f'bag{n}')
+        bag.mkdir()
+        bag.joinpath('bagit.txt').write_bytes(b'BagIt-Version: 0.97')
+    index = CountingIndex(lint_er.index_package(good_package))
+    given = []
+    no_bag = lint_er.RULES['package_has_no_bag']
+    monkeypatch.setitem(lint_er.RULES, 'package_has_no_bag', no_bag._replace(
+        package_hook=lambda package, index, findings:
+            given.append(findings) or no_bag.package_hook(package, index, findings)))
+    findings = {}
+
+    counted = lint_er.check_package(good_package, findings=findings)
+    result_only = lint_er.check_package(good_package, count_findings=False)
+
+    assert counted == result_only == ('invalid', ['package_has_no_bag'])
+    assert findings['package_has_no_bag'].total == 3
+    assert given[1].count_all is False
+    assert lint_er.package_has_no_bag(good_package, index) == False
+    assert index.read < len(index)
+
+def test_lint_output_jsonl(monkeypatch, mixed_packages, capsys):
+    """Run entire script with --output jsonl, one record per package on stdout"""
+    monkeypatch.setattr(
+        'sys.argv', [
+            '../bin/lint_er.py',
+            '--directory', str(mixed_packages),
+            '--output', 'jsonl'
+        ]
+    )
+
+    lint_er.main()
+
+    captured = capsys.readouterr()
+    records = [json.loads(line) for line in captured.out.splitlines()]
+    assert len(records) == 7
+    zero_bytes = [x for x in records if x['package'] == 'M12345_ER_0003'][0]
+    assert zero_bytes['result'] == 'invalid'
+    assert zero_bytes['findings'] == {
+        'package_has_no_zero_bytes_file': ['objects/zerobytes.txt']
+    }
+    assert 'Total packages ran: 7' in captured.err
+
+def test_findings_keep_sample_and_count():
+    """Findings keep only a sample of the paths but count every one"""
+    findings = lint_er.Findings(limit=3)
+    findings.extend(f'objects/file{n}' for n in range(1000))
+
+    assert findings == ['objects/file0', 'objects/file1', 'objects/file2']
+    assert findings.total == 1000
+    assert findings.describe(Path('pkg')).endswith(' and 997 more')
+
+def test_zero_bytes_findings_are_capped(good_package, caplog):
+    """A package with many zero bytes files logs and keeps only a sample"""
+    for n in range(50):
+        good_package.joinpath('objects').joinpath(f'zero{n}.txt').touch()
+    findings = {}
+
+    lint_er.check_package(good_package, findings=findings, findings_sample=5)
+
+    assert len(findings['package_has_no_zero_bytes_file']) == 5
+    assert findings['package_has_no_zero_bytes_file'].total == 50
+    assert 'and 45 more' in caplog.text
+
+def test_result_only_findings_keep_sample_size(good_package, caplog):
+    """Checks that only give a result log the sample size they are given,
+    and stop reading the index once the sample is full"""
+    for n in range(50):
+        good_package.joinpath('objects').joinpath(f'.hidden{n}').write_bytes(b'x')
+    index = CountingIndex(lint_er.index_package(good_package))
+
+    result, failed = lint_er.check_package(good_package, index, findings_sample=2,
+                                           rules=['package_has_no_hidden_file'],
+                                           count_findings=False)
+
+    assert (result, failed) == ('needs review', ['package_has_no_hidden_file'])
+    assert caplog.text.count('.hidden') == 2
+    assert 'and more' in caplog.text
+    assert index.read < len(index)
+
+def test_lint_text_output_findings_sample(monkeypatch, good_package, caplog):
+    """--findings_sample sets how many paths the text output logs"""
+    for n in range(30):
+        good_package.joinpath('objects').joinpath(f'zero{n}.txt').touch()
+    monkeypatch.setattr('sys.argv', ['../bin/lint_er.py', '--package', str(good_package),
+                                     '--findings_sample', '2'])
+
+    lint_er.main()
+
+    assert len(re.findall(r'zero\d+\.txt', caplog.text)) == 2
+
+def test_default_rules_match_check_lists():
+    """The default rules are the less strict and strict checks, in order"""
+    rules = lint_er.resolve_rules()
+
+    assert [x.name for x in rules] == [
+        x.__name__ for x in lint_er.less_strict_tests + lint_er.strict_tests
+    ]
+
+def test_entry_rule_runs_in_the_package_walk(monkeypatch, good_package):
+    """Entry rules flag entries while the package is indexed, in one walk"""
+    long_name = 'a' * 250 + '.txt'
+    good_package.joinpath('objects').joinpath(long_name).write_bytes(b'long')
+    calls = []
+    index_package = lint_er.index_package
+
+    def counting_index(package, *args, **kwargs):
+        calls.append(package)
+        return index_package(package, *args, **kwargs)
+
+    monkeypatch.setattr(lint_er, 'index_package', counting_index)
+    findings = {}
+    rules = lint_er.resolve_rules() + [lint_er.RULES['package_has_no_path_over_255_bytes']]
+
+    result, failed = lint_er.check_package(good_package, findings=findings, rules=rules)
+
+    assert result == 'invalid'
+    assert failed == ['package_has_no_path_over_255_bytes']
+    assert findings['package_has_no_path_over_255_bytes'] == [f'objects/{long_name}']
+    assert calls == [good_package]
+
+def test_rule_set_file(tmp_path, good_package):
+    """A site rule set picks the rules to run and can change their severity"""
+    good_package.joinpath('objects').joinpath('zerobytes.txt').touch()
+    rule_file = tmp_path / 'site_rules.json'
+    rule_file.write_text(json.dumps({
+        'rules': ['package_has_valid_name', 'package_has_no_zero_bytes_file'],
+        'severity': {'package_has_no_zero_bytes_file': 'needs review'}
+    }))
+
+    rules = lint_er.load_rule_set(rule_file)
+    result, failed = lint_er.check_package(good_package, rules=rules)
+
+    assert [x.name for x in rules] == ['package_has_valid_name', 'package_has_no_zero_bytes_file']
+    assert result == 'needs review'
+    assert failed == ['package_has_no_zero_bytes_file']
+
+def test_rule_set_file_unknown_rule(tmp_path):
+    """A rule set naming a rule that does not exist is rejected"""
+    rule_file = tmp_path / 'site_rules.json'
+    rule_file.write_text(json.dumps({'rules': ['package_is_perfect']}))
+
+    with pytest.raises(ValueError):
+        lint_er.load_rule_set(rule_file)
+
+def test_cache_is_kept_per_rule_set(monkeypatch, tmp_path, good_package):
+    """A cached result is not reused when a different rule set is run"""
+    checked = count_checks(monkeypatch)
+    cache_file = tmp_path / 'cache.sqlite'
+    strict = lint_er.resolve_rules() + [lint_er.RULES['package_has_no_file_over_100_gb']]
+
+    list(lint_er.lint_packages([good_package], cache=lint_er.LintCache(cache_file)))
+    list(lint_er.lint_packages([good_package], cache=lint_er.LintCache(cache_file, strict),
+                               rules=strict))
+    list(lint_er.lint_packages([good_package], cache=lint_er.LintCache(cache_file, strict),
+                               rules=strict))
+
+    assert len(checked) == 2
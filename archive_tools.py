@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+'''
+One entry point for the archive scripts, for cron wrappers and the shell:
+
+    archive_tools.py lint --directory /path/to/M12345
+    archive_tools.py compare-paths -d_one /drive/M12345 -d_two /share/M12345
+    archive_tools.py compare-bags -d_dupe /drive -d_main /share --report report.csv
+    archive_tools.py eavie-upload -d /path/to/access_copies
+    archive_tools.py <command> --help
+
+Link or alias it as archive-tools. Everything after the command goes to the
+script's own options. A script is only imported once its command runs, and
+the scripts import bagit, boto3, hashing and SQLite only where they are
+used, so --help and other light runs start quickly; see
+benchmarks/bench_archive_tools.py --startup.
+'''
+
+import argparse
+import importlib
+import os
+import sys
+
+# os.path rather than pathlib, as this runs before anything else is imported
+REPO = os.path.dirname(os.path.realpath(__file__))
+
+# command: (module, folder it is in, help)
+COMMANDS = {
+    'lint': ('lint_er', os.path.join(REPO, '20230417_Unit_Testing_presentation'),
+             'lint ER packages'),
+    'compare-paths': ('compare_paths', REPO,
+                      'compare the paths and files of two directories'),
+    'compare-bags': ('compare_bags', REPO,
+                     'compare, audit or deduplicate bags in two locations'),
+    'eavie-upload': ('misc_eavie_upload', REPO,
+                     'validate and upload access copies and JSON to EAVie'),
+}
+
+def get_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='archive-tools',
+        description='Run lint_er, compare_paths, compare_bags or misc_eavie_upload',
+        epilog='commands:\n' + '\n'.join(f'  {name:15} {help}'
+                                         for name, (_, _, help) in COMMANDS.items()),
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=list(COMMANDS), metavar='command',
+                        help='one of the commands below')
+    parser.add_argument('args', nargs=argparse.REMAINDER,
+                        help='options of the script, see archive-tools <command> --help')
+    return parser.parse_args(argv)
+
+def run(command: str, args: list) -> None:
+    module_name, folder, _ = COMMANDS[command]
+    if folder not in sys.path:
+        sys.path.insert(0, folder)
+    # the scripts read their own options from sys.argv
+    sys.argv = [f'archive-tools {command}', *args]
+    importlib.import_module(module_name).main()
+
+def main():
+    args = get_args()
+    run(args.command, args.args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,414 @@
+#!/usr/bin/env python3
+
+'''
+Benchmark the archive scripts against synthetic trees.
+
+Generates M###_ER_#### packages, bag directories and AMI media/JSON folders
+of a given number of files, then times each stage in its own process:
+wall time, filesystem events, read syscalls and peak RSS. Results can be
+saved as a baseline and later runs compared against it, so a slowdown in
+the scripts shows up before it reaches the production drives.
+
+fs_events counts the audit events Python raises for opens, listings and
+other os calls. stat, lstat and DirEntry.stat/is_dir raise none, so stats,
+which are most of the filesystem calls of a walk, are not in it; read_syscalls
+does not count them either. peak_rss_kb is the peak RSS of the timed part
+alone where the kernel can reset it (Linux), and of the whole stage process,
+setup included, elsewhere; setup_rss_kb is the peak after setup. A stage
+that raises, crashes or runs over --timeout is reported as failed, and the
+run exits with an error.
+
+    python benchmarks/bench_archive_tools.py --sizes 1000 100000 --save_baseline base.json
+    python benchmarks/bench_archive_tools.py --sizes 1000 100000 --baseline base.json
+
+--startup instead times archive_tools.py --help and each command's --help,
+and fails if any takes more than --startup_limit on top of python -c pass,
+or loads a heavy module. The limit is a budget above the interpreter's own
+startup, not the total of under 100 ms first set for --help: python -c pass
+alone takes from about 15 ms on a fast laptop to over 100 ms on a loaded
+CI runner, so a total says more about the machine than about the scripts.
+The 60 ms default is what the scripts' own imports and argparse may add.
+'''
+
+import argparse
+import hashlib
+import queue
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+from pathlib import Path
+
+REPO = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO))
+sys.path.insert(0, str(REPO / '20230417_Unit_Testing_presentation'))
+
+FS_EVENTS = 0
+COUNTING = False
+
+def _count_fs_events(event, args):
+    # stat calls raise no audit event, so they are not counted
+    global FS_EVENTS
+    if COUNTING and (event == 'open' or event.startswith('os.')):
+        FS_EVENTS += 1
+
+def get_args():
+    parser = argparse.ArgumentParser(description='''Benchmark lint_er, compare_paths,
+                                     compare_bags and misc_eavie_upload stages on
+                                     synthetic archive trees''')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000],
+                        help='''number of files in each generated tree, e.g.
+                        1000 100000 1000000. Default 1000''')
+    parser.add_argument('--stages', nargs='+', choices=list(STAGES), default=list(STAGES),
+                        help='stages to run. Default all')
+    parser.add_argument('--files_per_package', type=int, default=100,
+                        help='files in each ER package or bag. Default 100')
+    parser.add_argument('--depth', type=int, default=3,
+                        help='folder depth inside each package or bag. Default 3')
+    parser.add_argument('--file_size', type=int, default=64,
+                        help='bytes in each generated file. Default 64')
+    parser.add_argument('--workdir',
+                        help='''folder to generate trees in, e.g. on the drive to
+                        measure. Default a temporary folder''')
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the generated trees')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--save_baseline', help='write the results as a baseline to this JSON file')
+    parser.add_argument('--baseline', help='compare the results with this baseline JSON file')
+    parser.add_argument('--timeout', type=float, default=3600,
+                        help='''seconds a stage may run before it is stopped and
+                        reported as failed. Default 3600''')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='''fraction a stage may be slower than the baseline
+                        before it counts as a regression. Default 0.25''')
+    parser.add_argument('--startup', action='store_true',
+                        help='time the startup of archive_tools.py instead of the stages')
+    parser.add_argument('--startup_limit', type=float, default=60,
+                        help='''milliseconds --startup allows each invocation on top
+                        of the startup of python -c pass. Default 60''')
+    parser.add_argument('--repeat', type=int, default=10,
+                        help='runs of each invocation with --startup, the median is kept. Default 10')
+    return parser.parse_args()
+
+# Generators
+def nested_dir(j: int, depth: int) -> str:
+    return '/'.join(f'dir{(j // 10 ** k) % 10}' for k in range(depth))
+
+def file_bytes(j: int, size: int) -> bytes:
+    return (f'{j:012d}' * (size // 12 + 1)).encode()[:size]
+
+def make_er_packages(root: Path, n_files: int, files_per_package: int,
+                     depth: int, file_size: int) -> Path:
+    # root/M12345/M12345_ER_0001/{objects,metadata}
+    collection = root.joinpath('M12345')
+    for i in range(max(1, n_files // files_per_package)):
+        pkg = collection.joinpath(f'M12345_ER_{i + 1:04d}')
+        pkg.joinpath('metadata').mkdir(parents=True)
+        pkg.joinpath('metadata', f'{pkg.name}.csv').write_bytes(b'md')
+        for j in range(files_per_package):
+            folder = pkg.joinpath('objects', nested_dir(j, depth))
+            folder.mkdir(parents=True, exist_ok=True)
+            folder.joinpath(f'file{j}.txt').write_bytes(file_bytes(j, file_size))
+    return root
+
+def make_bags(root: Path, n_files: int, files_per_bag: int,
+              depth: int, file_size: int) -> Path:
+    # bags are written directly, with a sha256 payload manifest, instead of
+    # through bagit.make_bag, so a million-file tree takes minutes not hours
+    for i in range(max(1, n_files // files_per_bag)):
+        bag = root.joinpath(f'group{i % 10}', f'{100000 + i}')
+        manifest = []
+        for j in range(files_per_bag):
+            rel = f'data/{nested_dir(j, depth)}/file{j}.txt'
+            content = file_bytes(i * files_per_bag + j, file_size)
+            bag.joinpath(rel).parent.mkdir(parents=True, exist_ok=True)
+            bag.joinpath(rel).write_bytes(content)
+            manifest.append(f'{hashlib.sha256(content).hexdigest()}  {rel}\n')
+        bag.joinpath('bagit.txt').write_text('BagIt-Version: 0.97\nTag-File-Character-Encoding: UTF-8\n')
+        bag.joinpath('bag-info.txt').write_text(f'Payload-Oxum: {file_size * files_per_bag}.{files_per_bag}\n')
+        bag.joinpath('manifest-sha256.txt').write_text(''.join(manifest))
+    return root
+
+def make_ami_folder(root: Path, n_files: int, file_size: int) -> Path:
+    root.mkdir(parents=True, exist_ok=True)
+    for i in range(max(1, n_files // 2)):
+        media = root.joinpath(f'mym_{100000 + i:06d}_v01_sc.mp4')
+        media.write_bytes(file_bytes(i, file_size))
+        root.joinpath(f'{media.stem}.json').write_text(json.dumps({
+            'asset': {'referenceFilename': media.name},
+            'bibliographic': {'barcode': f'33433{i:09d}'}
+        }))
+    return root
+
+# Stages
+# each stage takes the generated trees, does untimed setup,
+# and returns the function to time
+def stage_lint_package(trees):
+    import lint_er
+    lint_er.LOGGER.disabled = True
+    packages = sorted(trees['er'].joinpath('M12345').iterdir())
+    return lambda: [lint_er.check_package(p) for p in packages]
+
+def stage_find_all_paths(trees):
+    import compare_paths
+    return lambda: compare_paths.find_all_paths(trees['er'])
+
+def stage_compare_bags_index(trees):
+    import compare_bags
+    return lambda: compare_bags.index_bags(trees['main'])
+
+def stage_compare_bags_validate(trees):
+    import compare_bags
+    bags = [trees['main'] / p for p in compare_bags.index_bags(trees['main'])['bags'].values()]
+    return lambda: compare_bags.validate_bags_in_main(bags)
+
+def stage_compare_bags_manifests(trees):
+    import compare_bags
+    main = compare_bags.index_bags(trees['main'])['bags']
+    dupe = compare_bags.index_bags(trees['dupe'])['bags']
+    valid, _ = compare_bags.validate_bags_in_main([trees['main'] / p for p in main.values()])
+    dupe_paths = [trees['dupe'] / p for p in dupe.values()]
+    return lambda: compare_bags.compare_payload_manifests(valid, dupe_paths)
+
+def stage_eavie_validate(trees):
+    import misc_eavie_upload
+    logging.disable(logging.WARNING)
+    filepaths = [x for x in trees['ami'].iterdir() if x.is_file()]
+
+    def run():
+        ami_dict, _ = misc_eavie_upload.pair_ami_files(filepaths)
+        return misc_eavie_upload.validate_items(ami_dict)
+    return run
+
+STAGES = {
+    'lint_er.lint_package': stage_lint_package,
+    'compare_paths.find_all_paths': stage_find_all_paths,
+    'compare_bags.index': stage_compare_bags_index,
+    'compare_bags.validate': stage_compare_bags_validate,
+    'compare_bags.manifests': stage_compare_bags_manifests,
+    'misc_eavie_upload.validate': stage_eavie_validate,
+}
+
+def read_syscalls():
+    # Linux only; counts read(2)-like calls of this process
+    try:
+        with open('/proc/self/io') as f:
+            return int(dict(line.split(': ') for line in f.read().splitlines())['syscr'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+def peak_rss_kb() -> int:
+    # VmHWM can be reset, ru_maxrss cannot; ru_maxrss is in KB on Linux
+    # and in bytes on macOS
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss // 1024 if sys.platform == 'darwin' else maxrss
+
+def reset_peak_rss() -> bool:
+    # Linux 4.0 and later reset VmHWM to the current RSS when 5 is written to clear_refs
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+FAILED = {'wall_s': None, 'fs_events': None, 'read_syscalls': None,
+          'setup_rss_kb': None, 'peak_rss_kb': None}
+
+def run_stage(stage: str, trees: dict, queue) -> None:
+    global COUNTING
+    # stdout of the scripts is not part of the measurement
+    sys.stdout = open(os.devnull, 'w')
+    sys.addaudithook(_count_fs_events)
+    try:
+        fn = STAGES[stage](trees)
+        setup_rss = peak_rss_kb()
+        rss_includes_setup = not reset_peak_rss()
+
+        syscr = read_syscalls()
+        COUNTING = True
+        start = time.perf_counter()
+        fn()
+        wall = time.perf_counter() - start
+        COUNTING = False
+        syscr_after = read_syscalls()
+    except Exception:
+        queue.put({**FAILED, 'error': traceback.format_exc(limit=-3).strip()})
+        return
+
+    queue.put({'wall_s': round(wall, 4),
+               'fs_events': FS_EVENTS,
+               'read_syscalls': syscr_after - syscr if syscr is not None else None,
+               'setup_rss_kb': setup_rss,
+               'peak_rss_kb': peak_rss_kb(),
+               'rss_includes_setup': rss_includes_setup})
+
+def measure(stage: str, trees: dict, timeout: float = None) -> dict:
+    # a fresh process per stage, so peak RSS belongs to that stage alone.
+    # The queue is polled, so a stage that dies without a result, e.g.
+    # killed for memory, or that runs past the timeout, fails instead of hanging
+    ctx = multiprocessing.get_context('spawn')
+    results = ctx.Queue()
+    proc = ctx.Process(target=run_stage, args=(stage, trees, results))
+    proc.start()
+    deadline = time.monotonic() + timeout if timeout else None
+    result = None
+
+    while result is None:
+        try:
+            result = results.get(timeout=1)
+        except queue.Empty:
+            if not proc.is_alive():
+                try:
+                    result = results.get(timeout=1)
+                except queue.Empty:
+                    result = {**FAILED, 'error': f'stage process exited with code {proc.exitcode}'}
+            elif deadline and time.monotonic() > deadline:
+                proc.terminate()
+                result = {**FAILED, 'error': f'stopped after {timeout}s'}
+
+    proc.join()
+    return result
+
+def generate(workdir: Path, n_files: int, args) -> dict:
+    trees = {'er': workdir / 'er', 'main': workdir / 'bags_main',
+             'dupe': workdir / 'bags_dupe', 'ami': workdir / 'ami'}
+    print(f'Generating trees of {n_files} files in {workdir}')
+    make_er_packages(trees['er'], n_files, args.files_per_package, args.depth, args.file_size)
+    make_bags(trees['main'], n_files, args.files_per_package, args.depth, args.file_size)
+    make_bags(trees['dupe'], n_files, args.files_per_package, args.depth, args.file_size)
+    make_ami_folder(trees['ami'], n_files, args.file_size)
+    return trees
+
+def find_regressions(results: list, baseline: list, tolerance: float) -> list:
+    base = {(r['stage'], r['files']): r for r in baseline}
+    regressions = []
+    for r in results:
+        b = base.get((r['stage'], r['files']))
+        # failed stages are reported on their own
+        if b and r['wall_s'] is not None and b['wall_s'] is not None and \
+                r['wall_s'] > b['wall_s'] * (1 + tolerance):
+            regressions.append(f"{r['stage']} at {r['files']} files: "
+                               f"{r['wall_s']}s, baseline {b['wall_s']}s")
+    return regressions
+
+# Startup
+STARTUP_RUNS = [['--help'], ['lint', '--help'], ['compare-paths', '--help'],
+                ['compare-bags', '--help'], ['eavie-upload', '--help']]
+HEAVY_MODULES = ['bagit', 'boto3', 'botocore', 'hashlib', 'sqlite3', 'multiprocessing']
+
+# runs archive_tools.py like the shell would, then lists the heavy modules it loaded
+LOADED_PROBE = '''
+import runpy, sys
+sys.argv = sys.argv[1:]
+try:
+    runpy.run_path(sys.argv[0], run_name='__main__')
+except SystemExit:
+    pass
+sys.stderr.write(repr([m for m in {heavy!r} if m in sys.modules]))
+'''
+
+def time_invocation(argv: list) -> float:
+    start = time.perf_counter()
+    subprocess.run(argv, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return (time.perf_counter() - start) * 1000
+
+def time_above_interpreter(argv: list, repeat: int) -> tuple:
+    # each run follows a python -c pass, so load that comes and goes on a
+    # shared runner shifts both; the medians of the run and of its
+    # difference to the pass before it are returned
+    runs, above = [], []
+    for _ in range(repeat):
+        interpreter = time_invocation([sys.executable, '-c', 'pass'])
+        runs.append(time_invocation(argv))
+        above.append(runs[-1] - interpreter)
+    return statistics.median(runs), statistics.median(above)
+
+def check_startup(limit: float, repeat: int) -> list:
+    tool = str(REPO / 'archive_tools.py')
+    interpreter = statistics.median(time_invocation([sys.executable, '-c', 'pass'])
+                                    for _ in range(repeat))
+    print(f'{"python -c pass":40} {interpreter:8.1f} ms')
+    problems = []
+
+    for run in STARTUP_RUNS:
+        ms, above = time_above_interpreter([sys.executable, tool, *run], repeat)
+        probe = subprocess.run([sys.executable, '-c', LOADED_PROBE.format(heavy=HEAVY_MODULES),
+                                tool, *run], stdout=subprocess.DEVNULL,
+                               stderr=subprocess.PIPE, text=True)
+        loaded = probe.stderr.strip().splitlines()[-1]
+        name = 'archive_tools.py ' + ' '.join(run)
+        print(f'{name:40} {ms:8.1f} ms, {above:6.1f} ms above python -c pass, '
+              f'heavy modules loaded: {loaded}')
+        if above > limit:
+            problems.append(f'{name} took {above:.1f} ms above python -c pass, over {limit} ms')
+        if loaded != '[]':
+            problems.append(f'{name} loaded {loaded}')
+
+    return problems
+
+def main():
+    args = get_args()
+    results = []
+
+    if args.startup:
+        problems = check_startup(args.startup_limit, args.repeat)
+        if problems:
+            print('Startup is too slow:\n' + '\n'.join(problems))
+            sys.exit(1)
+        print(f'Every invocation started within {args.startup_limit} ms above python -c pass')
+        return
+
+    failed = []
+    for n_files in args.sizes:
+        workdir = Path(tempfile.mkdtemp(prefix=f'bench_{n_files}_', dir=args.workdir))
+        try:
+            trees = generate(workdir, n_files, args)
+            for stage in args.stages:
+                result = {'stage': stage, 'files': n_files, **measure(stage, trees, args.timeout)}
+                if result.get('error'):
+                    print(f"{stage:32} {n_files:>9} files FAILED: {result['error'].splitlines()[-1]}")
+                    failed.append(f'{stage} at {n_files} files')
+                else:
+                    print(f"{stage:32} {n_files:>9} files {result['wall_s']:>10.3f}s "
+                          f"{result['fs_events']:>9} fs events {result['peak_rss_kb']:>9} KB peak RSS")
+                results.append(result)
+        finally:
+            if not args.keep:
+                shutil.rmtree(workdir)
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2))
+    if args.save_baseline:
+        Path(args.save_baseline).write_text(json.dumps(results, indent=2))
+        print(f'Baseline saved to {args.save_baseline}')
+    regressions = []
+    if args.baseline:
+        regressions = find_regressions(results, json.loads(Path(args.baseline).read_text()),
+                                       args.tolerance)
+        if regressions:
+            print('Slower than the baseline:\n' + '\n'.join(regressions))
+        else:
+            print(f'No stage is slower than {args.baseline} allows')
+    if failed:
+        print('These stages failed:\n' + '\n'.join(failed))
+    if regressions or failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,97 @@
+# bagit, hashing, SQLite and process pools are imported by the functions
+# that use them, so --help and the light modes start quickly
 import argparse
-import bagit
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from contextlib import contextmanager
+import csv
+import json
 import logging
+import os
 from pathlib import Path
 import re
+import shlex
+import shutil
+import threading
+import time
+from scan_dirs import scan_tree
+from manifest_store import PREFERRED_ALGORITHMS, diff_stores, open_store, shared_algorithm
+
+BAG_ID = re.compile(r'^\d{6}$')
+BAG_INDEX_VERSION = 1
+REPORT_FIELDS = ['bag', 'status', 'main', 'duplicate', 'missing', 'extra', 'mismatched', 'reclaimed']
+DUPLICATE_FIELDS = ['bag', 'status', 'duplicate', 'main_bag', 'files', 'matched', 'moved', 'not_found']
+AUDIT_FIELDS = ['bag', 'status', 'main', 'files', 'missing', 'mismatched', 'unreadable', 'extra',
+                'error']
+AUDIT_CHUNK_SIZE = 1024 * 1024
+# from linux/fs.h, clones a file's extents on btrfs, XFS and other CoW filesystems
+FICLONE = 0x40049409
 
 def _make_parser():
     parser = argparse.ArgumentParser(description='Compare bags in two locations using their payload manifest entries')
     parser.add_argument('-d_dupe', '--directory_duplicate',
-                        help = '''required. Directory one is the directory with potential duplicated bags.
-                        It should be a path to a directory of bags or a hard drive.''',
-                        required=True)
+                        help = '''required unless --audit is used. Directory one is the directory with
+                        potential duplicated bags. It should be a path to a directory of bags or a hard drive.''')
     parser.add_argument('-d_main', '--directory_main',
                         help = f'''required. Directory two is the directory to be compared against,
                         supposedly having the authoritative source.
                         It should be a path to a directory of bags or a hard drive.''',
                         required=True)
+    parser.add_argument('--bag_index',
+                        help = '''optional. A JSON file to keep the index of bags in the
+                        main directory between runs. The index is reused while no folder
+                        above the bags has changed, and rebuilt otherwise.''')
+
+    parser.add_argument('--workers',
+                        type=int,
+                        default=1,
+                        help = '''optional. Number of bags in the main directory to
+                        validate at the same time, each in its own process. With --audit,
+                        the number of payload files hashed at the same time. Default 1''')
+    parser.add_argument('--scan_workers',
+                        type=int,
+                        default=1,
+                        help = '''optional. Number of folders listed at the same time while
+                        looking for bags; raise it for network shares. Default 1''')
+    parser.add_argument('--fixity',
+                        action='store_true',
+                        help = '''optional. Validate the checksums of every payload file
+                        in the main directory bags, instead of only checking completeness''')
+    parser.add_argument('--report',
+                        help = '''optional. A file to write the comparison of every bag to,
+                        one bag per line, as it is compared. CSV if the filename ends with
+                        .csv, otherwise JSON lines''')
+    parser.add_argument('--manifest_store',
+                        help = '''optional. A folder to keep compact, sorted copies of the payload
+                        manifests in. Bags are then compared by merging the two sorted manifests,
+                        without loading the duplicate bag, and the copies are reused while the
+                        manifests are unchanged. For bags with millions of files''')
+    parser.add_argument('--dedup',
+                        choices=['hardlink', 'reflink', 'plan'],
+                        help = '''optional. Reclaim the space of duplicate bags that are identical
+                        to the main directory, after checking every payload file byte by byte.
+                        hardlink or reflink replaces each duplicate payload file with a link to or
+                        clone of the main copy, where the filesystem allows it. plan writes a
+                        script deleting the duplicate bags to --dedup_plan instead, for review''')
+    parser.add_argument('--dedup_plan',
+                        default='dedup_plan.sh',
+                        help = '''optional. The deletion script written by --dedup plan.
+                        Default dedup_plan.sh''')
+    parser.add_argument('--find_duplicates',
+                        action='store_true',
+                        help = '''optional. Look for every duplicate bag's payload anywhere in the
+                        main directory by checksum, instead of only in the bag with the same ID.
+                        Reports full, renamed (same content under another bag ID), partial and
+                        unique bags, using only the manifests, without hashing any payload''')
+    parser.add_argument('--audit',
+                        help = '''optional. Audit the fixity of every bag in the main directory,
+                        hashing all payload files, and keep the progress in this checkpoint file.
+                        An interrupted audit resumes from the checkpoint, skipping the bags and
+                        files already audited; delete the file to start a new audit''')
+    parser.add_argument('--throttle',
+                        type=float,
+                        help = '''optional. With --audit, the most megabytes per second read
+                        by all workers together, so the audit leaves I/O for production work.
+                        Default no limit''')
 
     return parser
 
@@ -25,15 +102,81 @@ def find_bags_in_dupe_dir(args):
 
     bag_paths = []
     bag_ids = []
-    pattern = '^\d{6}$'
 
-    for p in path.rglob('*'):
-        if p.is_dir() and re.match(pattern, p.name):
-            bag_paths.append(p)
-            bag_ids.append(p.name)
+    def cannot_list(rel_dir, e):
+        logging.warning(f'Cannot list {path / rel_dir}: {e}')
+
+    for _, entry in scan_tree(path, getattr(args, 'scan_workers', 1), onerror=cannot_list):
+        if entry.is_dir() and BAG_ID.match(entry.name):
+            bag_paths.append(Path(entry.path))
+            bag_ids.append(entry.name)
 
     return bag_paths, bag_ids
 
+def index_bags(path: Path, scan_workers: int = 1) -> dict:
+    # walk the directory once, mapping each six-digit bag folder to its
+    # relative path; bag folders are not walked into, only the folders above them
+    bags = dict()
+    dir_mtimes = {'': os.stat(path).st_mtime_ns}
+
+    def above_bags(entry):
+        return entry.is_dir(follow_symlinks=False) and not BAG_ID.match(entry.name)
+
+    def cannot_list(rel_dir, e):
+        logging.warning(f'Cannot list {path / rel_dir}: {e}')
+
+    # only the folders above the bags are stat-ed and walked into
+    for rel_dir, entry in scan_tree(path, scan_workers, stat=above_bags,
+                                    descend=lambda rel_path, entry: above_bags(entry),
+                                    onerror=cannot_list):
+        if not entry.is_dir(follow_symlinks=False):
+            continue
+        rel_path = f'{rel_dir}/{entry.name}' if rel_dir else entry.name
+        if BAG_ID.match(entry.name):
+            if entry.name in bags:
+                logging.warning(f'{entry.name} is in the main directory more than once, '
+                                f'using {bags[entry.name]}')
+            else:
+                bags[entry.name] = rel_path
+        else:
+            dir_mtimes[rel_path] = entry.stat(follow_symlinks=False).st_mtime_ns
+
+    return {'version': BAG_INDEX_VERSION,
+            'root': str(path.resolve()),
+            'dirs': dir_mtimes,
+            'bags': bags}
+
+def bag_index_is_current(path: Path, index: dict) -> bool:
+    # a new, removed or renamed bag changes the mtime of the folder holding it,
+    # so the folders above the bags are stat-ed but nothing is listed again
+    if index.get('version') != BAG_INDEX_VERSION or index.get('root') != str(path.resolve()):
+        return False
+    for rel_dir, mtime in index['dirs'].items():
+        try:
+            if os.stat(os.path.join(path, rel_dir)).st_mtime_ns != mtime:
+                return False
+        except OSError:
+            return False
+    return True
+
+def load_bag_index(path: Path, index_file=None, scan_workers: int = 1) -> dict:
+    if index_file and Path(index_file).is_file():
+        try:
+            index = json.loads(Path(index_file).read_text())
+        except (OSError, ValueError) as e:
+            logging.warning(f'Cannot read bag index {index_file}, rebuilding it: {e}')
+        else:
+            if bag_index_is_current(path, index):
+                print(f'Using bag index {index_file}')
+                return index
+            print(f'Bag index {index_file} is out of date, rebuilding it')
+
+    index = index_bags(path, scan_workers)
+    if index_file:
+        Path(index_file).write_text(json.dumps(index))
+
+    return index
+
 def check_dupe_status_in_main(args, bag_ids):
     path = Path(args.directory_main)
     if not path.is_dir():
@@ -42,67 +185,641 @@ def check_dupe_status_in_main(args, bag_ids):
     bag_not_in_main = []
     bags_to_validate = []
 
+    bag_index = load_bag_index(path, getattr(args, 'bag_index', None),
+                               getattr(args, 'scan_workers', 1))['bags']
+
     for b in bag_ids:
-        bag_path = [x for x in path.rglob(b) if x.is_dir()]
-        if not bag_path:
+        if not b in bag_index:
             bag_not_in_main.append(b)
         else:
-            bags_to_validate.append(bag_path[0])
+            bags_to_validate.append(path / bag_index[b])
 
     return bag_not_in_main, bags_to_validate
 
-def validate_bags_in_main(bags_to_validate):
+def validate_bag(bag_path, fixity=False):
+    # runs in a worker process, so the error is returned as text rather than logged
+    import bagit
+    bag_in_main = bagit.Bag(str(bag_path))
+    try:
+        bag_in_main.validate(completeness_only = not fixity)
+        return True, None
+    except bagit.BagValidationError as e:
+        return False, e.message
+
+def validate_bags_in_main(bags_to_validate, workers=1, fixity=False):
+    # valid bags are kept by path, not as bagit.Bag, so their manifests are
+    # not all held in memory until every bag is compared
+    import bagit
     valid_in_main = dict()
     invalid_in_main = []
 
+    if workers <= 1:
+        for bag_path in bags_to_validate:
+            bag_in_main = bagit.Bag(str(bag_path))
+            try:
+                print(f'checking {bag_in_main}')
+                bag_in_main.validate(completeness_only = not fixity)
+                valid_in_main[bag_path.name] = bag_path
+            except bagit.BagValidationError as e:
+                logging.warning("Bag incomplete or invalid oxum: {0}".format(e.message))
+                invalid_in_main.append(bag_path.name)
+
+        return valid_in_main, invalid_in_main
+
+    results = dict()
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(validate_bag, bag_path, fixity): bag_path
+                   for bag_path in bags_to_validate}
+        for done, future in enumerate(as_completed(futures), start=1):
+            bag_path = futures[future]
+            results[bag_path] = future.result()
+            print(f'checked {done}/{len(futures)}: {bag_path}')
+
+    # outputs keep the order of bags_to_validate, whichever bag finished first
     for bag_path in bags_to_validate:
-        bag_in_main = bagit.Bag(str(bag_path))
-        try:
-            print(f'checking {bag_in_main}')
-            bag_in_main.validate(completeness_only = True)
-            valid_in_main[bag_path.name] = bag_in_main
-        except bagit.BagValidationError as e:
-            logging.warning("Bag incomplete or invalid oxum: {0}".format(e.message))
+        is_valid, message = results[bag_path]
+        if is_valid:
+            valid_in_main[bag_path.name] = bag_path
+        else:
+            logging.warning("Bag incomplete or invalid oxum: {0}".format(message))
             invalid_in_main.append(bag_path.name)
 
     return valid_in_main, invalid_in_main
 
-def compare_payload_manifests(valid_in_main, bag_paths):
+def compare_manifest_entries(main_entries: dict, dup_entries: dict) -> dict:
+    main_files = main_entries.keys()
+    dup_files = dup_entries.keys()
+    mismatched = []
+
+    for e in main_files & dup_files:
+        # only checksums of algorithms both manifests have can be compared
+        algs = main_entries[e].keys() & dup_entries[e].keys()
+        if not algs or any(main_entries[e][a] != dup_entries[e][a] for a in algs):
+            mismatched.append(e)
+
+    return {'missing': sorted(main_files - dup_files),
+            'extra': sorted(dup_files - main_files),
+            'mismatched': sorted(mismatched)}
+
+def compare_manifest_stores(main_path, dup_path, alg: str, store_dir) -> dict:
+    # only the differences are held in memory; both manifests stay on disk
+    result = {'missing': [], 'extra': [], 'mismatched': []}
+
+    with open_store(main_path, alg, store_dir) as main_store, \
+            open_store(dup_path, alg, store_dir) as dup_store:
+        for kind, path in diff_stores(main_store, dup_store):
+            result[kind].append(path)
+
+    return result
+
+def compare_bags_by_manifest(valid_in_main, bag_paths, store_dir=None):
+    # both bags of a pair are looked up by ID and read one pair at a time as
+    # they are compared, so results can be written out while the rest are
+    # still pending. With a store folder, the manifests of one shared
+    # algorithm are merged from their stores instead
+    import bagit
+    dup_paths = {p.name: p for p in bag_paths}
+
+    for bag_key, main_path in valid_in_main.items():
+        alg = shared_algorithm(main_path, dup_paths[bag_key]) if store_dir else None
+        if alg:
+            result = compare_manifest_stores(main_path, dup_paths[bag_key], alg, store_dir)
+        else:
+            result = compare_manifest_entries(bagit.Bag(str(main_path)).payload_entries(),
+                                              bagit.Bag(str(dup_paths[bag_key])).payload_entries())
+        if result['missing'] or result['extra'] or result['mismatched']:
+            status = 'different'
+        else:
+            status = 'identical'
+        yield {'bag': bag_key,
+               'status': status,
+               'main': str(main_path),
+               'duplicate': str(dup_paths[bag_key]),
+               **result}
+
+def checksum_keys(checksums: dict) -> list:
+    # payload_entries gives {algorithm: digest} for each file; a file is
+    # keyed by every checksum it has, so bags using different algorithms still meet
+    return [f'{alg}:{digest.lower()}' for alg, digest in checksums.items()]
+
+def index_payload_checksums(bag_paths) -> tuple:
+    # content-addressed index of the main directory: checksum key to the
+    # (bag, file) pairs holding that content, from the payload manifests only
+    import bagit
+    by_checksum = dict()
+    file_counts = dict()
+
+    for bag_path in bag_paths:
+        try:
+            entries = bagit.Bag(str(bag_path)).payload_entries()
+        except bagit.BagError as e:
+            # a six-digit folder that is not a bag has nothing to index
+            logging.warning(f'{bag_path} is not a bag, not indexed: {e}')
+            continue
+        file_counts[bag_path.name] = len(entries)
+        for path, checksums in entries.items():
+            for key in checksum_keys(checksums):
+                by_checksum.setdefault(key, set()).add((bag_path.name, path))
+
+    return by_checksum, file_counts
+
+def find_content_duplicates(by_checksum: dict, file_counts: dict, bag_paths):
+    # every duplicate bag is looked up file by file in the index, so the whole
+    # main directory is checked in one pass instead of bag against bag.
+    # The main bag holding most of its files is the match:
+    #   full     every file is in the bag with the same ID, and every file
+    #            of that bag is in the duplicate
+    #   renamed  the same, but in a bag with another ID
+    #   partial  some files are in the main directory
+    #   unique   no file is in the main directory
+    import bagit
+    for bag_path in bag_paths:
+        try:
+            entries = bagit.Bag(str(bag_path)).payload_entries()
+        except bagit.BagError as e:
+            logging.warning(f'{bag_path} is not a bag, skipped: {e}')
+            continue
+        matched = dict()
+        covered = dict()
+        moved = dict()
+        not_found = []
+
+        for path, checksums in entries.items():
+            holders = set()
+            for key in checksum_keys(checksums):
+                holders.update(by_checksum.get(key, ()))
+            if not holders:
+                not_found.append(path)
+                continue
+            same_path = {bag for bag, main_path in holders if main_path == path}
+            for bag, main_path in holders:
+                covered.setdefault(bag, set()).add(main_path)
+            for bag in {bag for bag, _ in holders}:
+                matched[bag] = matched.get(bag, 0) + 1
+                if bag not in same_path:
+                    moved.setdefault(bag, []).append(path)
+
+        # the bag with the same ID wins a tie
+        main_bag = max(matched, key=lambda bag: (matched[bag], bag == bag_path.name), default='')
+        if not main_bag:
+            status = 'unique'
+        elif (matched[main_bag] == len(entries) and
+                len(covered[main_bag]) == file_counts[main_bag]):
+            status = 'full' if main_bag == bag_path.name else 'renamed'
+        else:
+            status = 'partial'
+
+        yield {'bag': bag_path.name,
+               'status': status,
+               'duplicate': str(bag_path),
+               'main_bag': main_bag,
+               'files': len(entries),
+               'matched': matched.get(main_bag, 0),
+               'moved': sorted(moved.get(main_bag, [])),
+               'not_found': sorted(not_found)}
+
+@contextmanager
+def open_report(report, fields=REPORT_FIELDS):
+    if not report:
+        yield lambda result: None
+        return
+
+    with open(report, 'w', newline='', encoding='utf-8') as f:
+        if Path(report).suffix.lower() == '.csv':
+            writer = csv.DictWriter(f, fieldnames=fields)
+            writer.writeheader()
+            yield lambda result: writer.writerow(
+                {k: '; '.join(v) if isinstance(v, list) else v for k, v in result.items()})
+        else:
+            yield lambda result: f.write(json.dumps(result) + '\n')
+
+def paths_overlap(path_one, path_two) -> bool:
+    # the same folder, reached by any path, or one folder inside the other
+    path_one, path_two = Path(path_one).resolve(), Path(path_two).resolve()
+    try:
+        if os.path.samefile(path_one, path_two):
+            return True
+    except OSError:
+        pass
+    return (path_one == path_two or path_one in path_two.parents or
+            path_two in path_one.parents)
+
+def same_bytes(path_one: Path, path_two: Path) -> bool:
+    with open(path_one, 'rb', buffering=0) as f_one, open(path_two, 'rb', buffering=0) as f_two:
+        while True:
+            chunk_one = f_one.read(AUDIT_CHUNK_SIZE)
+            if chunk_one != f_two.read(AUDIT_CHUNK_SIZE):
+                return False
+            if not chunk_one:
+                return True
+
+def payload_on_disk(bag_path: Path) -> set:
+    payload = set()
+
+    def cannot_list(rel_dir, e):
+        # the folder's files are then missing from the set, so the bag is not deduplicated
+        logging.warning(f'Cannot list {bag_path / "data" / rel_dir}: {e}')
+
+    for rel_dir, entry in scan_tree(bag_path / 'data', onerror=cannot_list):
+        if not entry.is_dir(follow_symlinks=False):
+            payload.add(os.path.normpath(f'data/{rel_dir}/{entry.name}' if rel_dir
+                                         else f'data/{entry.name}'))
+    return payload
+
+def reflink(src: Path, dst: Path) -> None:
+    import fcntl
+    with open(src, 'rb') as f_src, open(dst, 'wb') as f_dst:
+        fcntl.ioctl(f_dst.fileno(), FICLONE, f_src.fileno())
+
+class BagDedup:
+    # called with each bag found identical by manifest. Nothing is changed unless
+    # the duplicate holds exactly the manifest's payload files and each one has
+    # the same bytes as the main copy. Returns the bytes reclaimed, or planned
+    # to be reclaimed, or None when the bag is left alone
+    def __init__(self, method: str, plan=None):
+        self.method = method
+        self.reclaimed = 0
+        self.plan = None
+        if method == 'plan':
+            self.plan = open(plan, 'w', encoding='utf-8')
+            self.plan.write('#!/bin/sh\n'
+                            f'# Deletion plan written by compare_bags on {time.strftime("%Y-%m-%d %H:%M")}.\n'
+                            '# Every bag below had the same manifest and the same payload bytes\n'
+                            '# as its main copy when the plan was written. Review before running.\n'
+                            'set -eu\n')
+
+    def verified(self, payload: set, main_path: Path, dup_path: Path) -> bool:
+        if payload_on_disk(dup_path) != payload:
+            logging.warning(f'{dup_path} has payload files not in its manifest, or misses some, '
+                            f'not deduplicated')
+            return False
+        for path in payload:
+            if not same_bytes(main_path / path, dup_path / path):
+                logging.warning(f'{dup_path / path} differs from {main_path / path}, '
+                                f'{dup_path.name} not deduplicated')
+                return False
+        return True
+
+    def link(self, main_file: Path, dup_file: Path) -> int:
+        main_st = os.stat(main_file)
+        dup_st = os.stat(dup_file)
+        if (main_st.st_dev, main_st.st_ino) == (dup_st.st_dev, dup_st.st_ino):
+            return 0
+
+        # made next to the duplicate and moved over it, so the file is never missing
+        tmp = dup_file.with_name(f'.{dup_file.name}.dedup')
+        try:
+            if self.method == 'hardlink':
+                os.link(main_file, tmp)
+            else:
+                reflink(main_file, tmp)
+                shutil.copystat(dup_file, tmp)
+            os.replace(tmp, dup_file)
+        except OSError:
+            if tmp.exists():
+                tmp.unlink()
+            raise
+
+        # space only comes back when the replaced file had no other link
+        return dup_st.st_size if dup_st.st_nlink == 1 else 0
+
+    def __call__(self, main_path: Path, dup_path: Path):
+        import bagit
+        main_path = Path(main_path)
+        # a bag compared with itself is identical, and deleting it would
+        # delete the only copy
+        if paths_overlap(main_path, dup_path):
+            logging.warning(f'{dup_path} is the main copy {main_path} or overlaps it, '
+                            f'not deduplicated')
+            return None
+        payload = set(bagit.Bag(str(main_path)).payload_entries())
+        if not self.verified(payload, main_path, dup_path):
+            return None
+
+        if self.plan:
+            size = sum(os.lstat(os.path.join(folder, name)).st_size
+                       for folder, _, files in os.walk(dup_path) for name in files)
+            # absolute paths, so the plan runs the same from any folder
+            self.plan.write(f'\n# {dup_path.name}: {size} bytes, same as '
+                            f'{main_path.resolve()}\n'
+                            f'rm -r -- {shlex.quote(str(dup_path.resolve()))}\n')
+            self.reclaimed += size
+            return size
+
+        reclaimed = 0
+        try:
+            for path in sorted(payload):
+                reclaimed += self.link(main_path / path, dup_path / path)
+        except OSError as e:
+            # a filesystem without hardlinks across the two folders, or without
+            # reflinks, fails on the first file; files linked so far stay linked
+            logging.warning(f'Cannot {self.method} {dup_path.name} to the main copy: {e}')
+        self.reclaimed += reclaimed
+        return reclaimed
+
+    def close(self) -> None:
+        if self.plan:
+            self.plan.close()
+
+def compare_payload_manifests(valid_in_main, bag_paths, report=None, store_dir=None,
+                              dedup=None):
     dup_missing_file = []
+    dup_extra_file = []
     unequal_hash = []
     identical_bag = []
 
-    for bag_key in valid_in_main:
-        main_entries = valid_in_main[bag_key].payload_entries()
+    with open_report(report) as write_result:
+        for result in compare_bags_by_manifest(valid_in_main, bag_paths, store_dir):
+            if dedup and result['status'] == 'identical':
+                result['reclaimed'] = dedup(valid_in_main[result['bag']], Path(result['duplicate']))
+            write_result(result)
+            bag_key = result['bag']
+            dup_missing_file.extend(f'{bag_key}/{e}' for e in result['missing'])
+            dup_extra_file.extend(f'{bag_key}/{e}' for e in result['extra'])
+            unequal_hash.extend(f'{bag_key}/{e}' for e in result['mismatched'])
+            if result['status'] == 'identical':
+                identical_bag.append(bag_key)
+
+    return dup_missing_file, dup_extra_file, unequal_hash, identical_bag
+
+def report_content_duplicates(args, bag_paths):
+    path = Path(args.directory_main)
+    main_bags = load_bag_index(path, args.bag_index, args.scan_workers)['bags']
+    by_checksum, file_counts = index_payload_checksums(path / p for p in main_bags.values())
+    print(f'Indexed {len(by_checksum)} checksums in {len(file_counts)} bags of the main directory')
+
+    by_status = {'full': [], 'renamed': [], 'partial': [], 'unique': []}
+    with open_report(args.report, DUPLICATE_FIELDS) as write_result:
+        for result in find_content_duplicates(by_checksum, file_counts, bag_paths):
+            write_result(result)
+            if result['status'] in ('full', 'unique'):
+                by_status[result['status']].append(result['bag'])
+            else:
+                by_status[result['status']].append(f"{result['bag']} -> {result['main_bag']}")
+
+    print(f'''
+    These bags are full duplicates of the bag with the same ID {by_status['full']}
+    These bags are full duplicates of a bag with another ID {by_status['renamed']}
+    These bags are partly in the main directory, review manually {by_status['partial']}
+    These bags have no file in the main directory {by_status['unique']}''')
+
+class Throttle:
+    # shared by the reader threads; each read is delayed until it fits
+    # under the rate, with up to a second of reads allowed in a burst
+    def __init__(self, bytes_per_second=None):
+        self.rate = bytes_per_second
+        self.lock = threading.Lock()
+        self.due = time.monotonic()
+
+    def take(self, n: int) -> None:
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.due = max(self.due, now - 1) + n / self.rate
+            delay = self.due - now
+        if delay > 0:
+            time.sleep(delay)
+
+def hash_payload_file(path: Path, alg: str, throttle: Throttle) -> tuple:
+    # (hex digest, size) of the file; the size is of the file that was opened,
+    # so it takes no second stat on the share. OSError is left to the caller
+    import hashlib
+    h = hashlib.new(alg)
+    with open(path, 'rb', buffering=0) as f:
+        size = os.fstat(f.fileno()).st_size
+        while True:
+            chunk = f.read(AUDIT_CHUNK_SIZE)
+            if not chunk:
+                return h.hexdigest(), size
+            throttle.take(len(chunk))
+            h.update(chunk)
 
-        for i in [x for x in bag_paths if x.name == bag_key]:
-            dup_bag = bagit.Bag(str(i))
-        dup_entries = dup_bag.payload_entries()
+class AuditCheckpoint:
+    # every audited file and finished bag is kept in SQLite, so an audit
+    # stopped after weeks picks up at the file it was on
+    def __init__(self, path):
+        import sqlite3
+        self.conn = sqlite3.connect(path)
+        with self.conn:
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS bags (bag TEXT PRIMARY KEY,
+                                 status TEXT, finished REAL)''')
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS files (bag TEXT, path TEXT,
+                                 status TEXT, size INTEGER, PRIMARY KEY (bag, path)) WITHOUT ROWID''')
 
-        counter = 0
-        for e in main_entries:
-            if not e in dup_entries:
-                dup_missing_file.append(e)
-                counter += 1
-            elif not main_entries[e] == dup_entries[e]:
-                unequal_hash.append(e)
-                counter += 1
-        if counter == 0:
-            identical_bag.append(bag_key)
+    def finished_bags(self) -> set:
+        return {row[0] for row in self.conn.execute('SELECT bag FROM bags')}
 
+    def audited_files(self, bag: str) -> set:
+        # unreadable files are tried again when an unfinished bag is resumed
+        return {row[0] for row in self.conn.execute(
+            'SELECT path FROM files WHERE bag = ? AND status != ?', (bag, 'unreadable'))}
 
-    return dup_missing_file, unequal_hash, identical_bag
+    def audited_bytes(self, bag: str) -> int:
+        return self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM files WHERE bag = ?',
+                                 (bag,)).fetchone()[0]
+
+    def record_file(self, bag: str, path: str, status: str, size: int) -> None:
+        # committed with the bag, or every so often by commit()
+        self.conn.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)', (bag, path, status, size))
+
+    def record_extra(self, bag: str, paths) -> None:
+        # payload files on disk but in no manifest; listed again on every run
+        # of the bag, so a file removed since an earlier run is not kept
+        self.conn.execute('DELETE FROM files WHERE bag = ? AND status = ?', (bag, 'extra'))
+        self.conn.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)',
+                              ((bag, path, 'extra', 0) for path in paths))
+
+    def commit(self) -> None:
+        self.conn.commit()
+
+    def finish_bag(self, bag: str, error: str = None) -> dict:
+        # error is why the bag could not be audited at all
+        rows = self.conn.execute('SELECT path, status FROM files WHERE bag = ? AND status != ?',
+                                 (bag, 'ok')).fetchall()
+        result = {'files': self.conn.execute('SELECT COUNT(*) FROM files WHERE bag = ? AND status != ?',
+                                             (bag, 'extra')).fetchone()[0],
+                  'missing': sorted(path for path, status in rows if status == 'missing'),
+                  'mismatched': sorted(path for path, status in rows if status == 'mismatched'),
+                  'unreadable': sorted(path for path, status in rows if status == 'unreadable'),
+                  'extra': sorted(path for path, status in rows if status == 'extra'),
+                  'error': error}
+        result['status'] = 'invalid' if rows or error else 'valid'
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO bags VALUES (?, ?, ?)',
+                              (bag, result['status'], time.time()))
+        return result
+
+    def close(self) -> None:
+        self.conn.commit()
+        self.conn.close()
+
+def payload_oxum_bytes(bag_path: Path) -> int:
+    # read from bag-info.txt alone, as opening the bag with bagit loads its manifests
+    try:
+        with open(bag_path / 'bag-info.txt', encoding='utf-8-sig') as f:
+            for line in f:
+                if line.startswith('Payload-Oxum:'):
+                    return int(line.split(':', 1)[1].strip().split('.')[0])
+    except (OSError, ValueError):
+        pass
+    return 0
+
+class AuditProgress:
+    # throughput is of this run only, so the ETA is not skewed by a resumed checkpoint
+    def __init__(self, total_bytes: int, every: float = 10):
+        self.total_bytes = total_bytes
+        self.done_bytes = 0
+        self.run_bytes = 0
+        self.files = 0
+        self.every = every
+        self.start = self.last = time.monotonic()
+
+    def add(self, size: int, hashed: bool = True) -> None:
+        self.done_bytes += size
+        if hashed:
+            self.run_bytes += size
+            self.files += 1
+        now = time.monotonic()
+        if now - self.last >= self.every:
+            self.last = now
+            print(self.describe(now))
+
+    def describe(self, now=None) -> str:
+        elapsed = (now or time.monotonic()) - self.start
+        rate = self.run_bytes / elapsed if elapsed else 0
+        remaining = max(self.total_bytes - self.done_bytes, 0)
+        eta = time.strftime('%H:%M:%S', time.gmtime(remaining / rate)) if rate else 'unknown'
+        if rate and remaining / rate >= 86400:
+            eta = f'{int(remaining / rate // 86400)}d {eta}'
+        return (f'audited {self.files} files, {self.done_bytes / 1e9:.1f}/{self.total_bytes / 1e9:.1f} GB, '
+                f'{rate / 1e6:.1f} MB/s, ETA {eta}')
+
+def audit_bag(bag: 'bagit.Bag', checkpoint: AuditCheckpoint, throttle: Throttle,
+              progress: AuditProgress, workers: int = 1) -> None:
+    # payload files are hashed on a thread pool with at most two per worker
+    # queued; each file is checked against the strongest checksum it has.
+    # Files in data/ that no manifest lists are recorded as extra, as bagit's
+    # validate fails on them too
+    bag_key = Path(bag.path).name
+    done = checkpoint.audited_files(bag_key)
+    entries = bag.payload_entries()
+
+    def audit_file(item):
+        path, checksums = item
+        alg = next((a for a in PREFERRED_ALGORITHMS if a in checksums), min(checksums))
+        try:
+            digest, size = hash_payload_file(Path(bag.path, path), alg, throttle)
+        except FileNotFoundError:
+            return path, 'missing', 0
+        except OSError as e:
+            # a permission or I/O error on one file does not stop the audit
+            logging.warning(f'Cannot read {bag_key}/{path}: {e}')
+            return path, 'unreadable', 0
+        status = 'ok' if digest == checksums[alg].lower() else 'mismatched'
+        return path, status, size
+
+    def record(future):
+        path, status, size = future.result()
+        checkpoint.record_file(bag_key, path, status, size)
+        progress.add(size)
+        if status != 'ok':
+            logging.warning(f'{bag_key}/{path} is {status}')
+
+    last_commit = time.monotonic()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        for item in entries.items():
+            if item[0] in done:
+                continue
+            pending.add(executor.submit(audit_file, item))
+            if len(pending) >= workers * 2:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    record(future)
+            if time.monotonic() - last_commit >= 1:
+                checkpoint.commit()
+                last_commit = time.monotonic()
+        for future in as_completed(pending):
+            record(future)
+
+    extra = payload_on_disk(Path(bag.path)) - set(entries)
+    for path in sorted(extra):
+        logging.warning(f'{bag_key}/{path} is extra')
+    checkpoint.record_extra(bag_key, extra)
+    checkpoint.commit()
+
+def audit_main(args):
+    import bagit
+    path = Path(args.directory_main)
+    bags = load_bag_index(path, args.bag_index, args.scan_workers)['bags']
+    checkpoint = AuditCheckpoint(args.audit)
+    finished = checkpoint.finished_bags()
+    to_audit = [path / bags[b] for b in sorted(bags) if b not in finished]
+    print(f'{len(finished)} bags audited before, {len(to_audit)} bags to audit')
+
+    throttle = Throttle(args.throttle * 1e6 if args.throttle else None)
+    progress = AuditProgress(sum(payload_oxum_bytes(bag_path) for bag_path in to_audit))
+    invalid = []
+
+    try:
+        with open_report(args.report, AUDIT_FIELDS) as write_result:
+            for bag_path in to_audit:
+                # bags are opened one at a time, so one bag's manifests are in memory
+                try:
+                    bag = bagit.Bag(str(bag_path))
+                except bagit.BagError as e:
+                    # a six-digit folder that is not a bag does not end the audit
+                    logging.warning(f'{bag_path} is not a bag: {e}')
+                    result = checkpoint.finish_bag(bag_path.name, f'not a bag: {e}')
+                else:
+                    # files audited in an earlier run count as done, without reading them again
+                    progress.add(checkpoint.audited_bytes(bag_path.name), hashed=False)
+                    audit_bag(bag, checkpoint, throttle, progress, args.workers)
+                    result = checkpoint.finish_bag(bag_path.name)
+                write_result({'bag': bag_path.name, 'main': str(bag_path), **result})
+                if result['status'] == 'invalid':
+                    invalid.append(bag_path.name)
+                print(f"{bag_path.name}: {result['status']}, {progress.describe()}")
+    finally:
+        checkpoint.close()
+
+    print(f'''
+    Audited bags: {len(to_audit)}
+    These bags have missing, changed, unreadable or extra files, or are not bags, review manually: {invalid}''')
 
 def main():
     parser = _make_parser()
     args = parser.parse_args()
 
+    if args.audit:
+        if args.workers < 1:
+            parser.error('--workers must be at least 1 with --audit')
+        audit_main(args)
+        return
+
+    if not args.directory_duplicate:
+        parser.error('the following arguments are required: -d_dupe/--directory_duplicate')
+    if paths_overlap(args.directory_duplicate, args.directory_main):
+        parser.error('-d_dupe and -d_main must not be the same directory or inside each other')
+
     bag_paths, bag_ids = find_bags_in_dupe_dir(args)
     print(f'''{bag_ids} will be checked in the main directory''')
 
+    if args.find_duplicates:
+        report_content_duplicates(args, bag_paths)
+        return
+
     bag_not_in_main, bags_to_validate = check_dupe_status_in_main(args, bag_ids)
-    valid_main, invalid_main = validate_bags_in_main(bags_to_validate)
-    dup_missing_file, unequal_hash, identical = compare_payload_manifests(valid_main, bag_paths)
+    valid_main, invalid_main = validate_bags_in_main(bags_to_validate, args.workers, args.fixity)
+    dedup = BagDedup(args.dedup, args.dedup_plan) if args.dedup else None
+    try:
+        dup_missing_file, dup_extra_file, unequal_hash, identical = compare_payload_manifests(
+            valid_main, bag_paths, args.report, args.manifest_store, dedup)
+    finally:
+        if dedup:
+            dedup.close()
 
     print(f'''
     Checked bags: {bag_ids}
@@ -111,9 +828,15 @@ def main():
 
     print(f'''
     Duplicate location is missing these file(s) {dup_missing_file}
+    Duplicate location has these extra file(s) {dup_extra_file}
     These hashes are different in the two location {unequal_hash}
     These bags are identical {identical}''')
 
+    if dedup and dedup.plan:
+        print(f'Deleting the identical bags in {args.dedup_plan} would reclaim {dedup.reclaimed} bytes')
+    elif dedup:
+        print(f'Reclaimed {dedup.reclaimed} bytes by replacing duplicate files with {args.dedup}s')
+
 '''
 dir1 is the smaller directory with potential duplicated bags
 dir2 is the major directory to compare against, e.g. 0_waiting_for_preservica
@@ -1,9 +1,16 @@
 import argparse
 import logging
+import os
 import re
+import stat
 import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from pathlib import Path
 import filecmp
+from scan_dirs import scan_tree
+
+CHUNK_SIZE = 8 * 1024 * 1024
+SNAPSHOT_HASH = 'blake2b'
 
 def _make_parser():
     parser = argparse.ArgumentParser(description='Compare two directories using rglob all')
@@ -11,19 +18,61 @@ def _make_parser():
                         help = '''required. First directory to compare''',
                         required=True)
     parser.add_argument('-d_two', '--directory_two',
-                        help = f'''required. Second directory to compare.''',
-                        required=True)
+                        help = f'''Second directory to compare. Required unless
+                        --snapshot or --write_snapshot is used.''')
+    parser.add_argument('--write_snapshot',
+                        help = '''write a snapshot of the first directory to this file,
+                        with the size, modification time and checksum of every file''')
+    parser.add_argument('--snapshot',
+                        help = '''compare the first directory against a snapshot written
+                        with --write_snapshot, instead of a second directory. Only files
+                        whose size or modification time changed are read again''')
+    parser.add_argument('--content',
+                        action='store_true',
+                        help = '''compare file contents byte by byte. Without it,
+                        files with the same size and modification time are
+                        treated as identical''')
+    parser.add_argument('--workers',
+                        type=int,
+                        default=4,
+                        help = '''number of files compared or hashed at the same
+                        time, default 4''')
+    parser.add_argument('--chunk_size',
+                        type=int,
+                        default=CHUNK_SIZE,
+                        help = f'''bytes read from each file at a time,
+                        default {CHUNK_SIZE}''')
+    parser.add_argument('--scan_workers',
+                        type=int,
+                        default=1,
+                        help = '''number of folders listed at the same time while
+                        walking each directory; raise it for network shares, default 1''')
 
     return parser
 
-def parts_tuple_to_path(tuple) -> Path:
-    newpath = Path()
-    for item in tuple:
-        newpath = newpath / item
+M_FOLDER = re.compile(r'M\d+')
+
+def root_anchors(dir: Path) -> list:
+    # M### folders in the directory path itself, as (name, offset) pairs,
+    # where offset is where the folder name starts in str(dir)
+    anchors = []
+    for i, part in enumerate(dir.parts):
+        if M_FOLDER.fullmatch(part) and not any(name == part for name, _ in anchors):
+            prefix = str(Path(*dir.parts[:i])) if i else ''
+            if prefix and not prefix.endswith(os.sep):
+                anchors.append((part, len(prefix) + 1))
+            else:
+                anchors.append((part, len(prefix)))
 
-    return newpath
+    return anchors
 
-def find_all_paths(dir):
+def find_all_paths(dir, scan_workers: int = 1, stats: dict = None):
+    # the M### folders above each entry are carried down the walk, so the
+    # relative path of an entry is a slice of its path string from the
+    # M### folder on. Paths are kept as strings to save memory on big trees.
+    # scan_workers folders are listed at the same time, see scan_dirs.
+    # With a stats dict, every entry is stat-ed by the scan and its stat
+    # result, following symlinks, is put in stats, or None if it has none
     path_set = set()
     parent_path = ''
     dir = Path(dir)
@@ -31,17 +80,36 @@ def find_all_paths(dir):
     if dir_is_empty(dir):
         sys.exit(f'{dir} is empty')
 
-    for item in dir.rglob('*'):
-        if not item.name.startswith('.') and not item.name == 'Thumbs.db':
-            item_parts = item.parts # item_parts is a tuple
-            for part in item_parts:
-                if re.match('^M\d+$', part):
-                    ind = item_parts.index(part)
-                    part_path = parts_tuple_to_path(item_parts[ind:])
-                    if not parent_path:
-                        parent_path = parts_tuple_to_path(item_parts[0:ind])
-                        # this is for reconstructing the original path for file comparison later
-                    path_set.add(part_path)
+    def cannot_list(rel_dir, e):
+        # like Path.rglob, a folder that cannot be listed is skipped
+        logging.warning(f'Cannot list {dir / rel_dir}: {e}')
+
+    anchors_of = {'': root_anchors(dir)}
+    for rel_dir, entry in scan_tree(dir, scan_workers, stat=stats is not None,
+                                    onerror=cannot_list):
+        anchors = anchors_of[rel_dir]
+        item_anchors = anchors
+        if (M_FOLDER.fullmatch(entry.name) and
+                not any(name == entry.name for name, _ in anchors)):
+            item_anchors = anchors + [(entry.name, len(entry.path) - len(entry.name))]
+
+        if not entry.name.startswith('.') and not entry.name == 'Thumbs.db':
+            if stats is not None:
+                try:
+                    st = entry.stat()
+                except OSError:
+                    # a broken symlink, or an entry removed during the walk
+                    st = None
+            for _, offset in item_anchors:
+                path_set.add(entry.path[offset:])
+                if stats is not None:
+                    stats[entry.path[offset:]] = st
+                if not parent_path:
+                    parent_path = Path(entry.path[:offset])
+                    # this is for reconstructing the original path for file comparison later
+
+        if entry.is_dir(follow_symlinks=False):
+            anchors_of[f'{rel_dir}/{entry.name}' if rel_dir else entry.name] = item_anchors
 
     return path_set, parent_path
 
@@ -51,12 +119,179 @@ def dir_is_empty(dir: Path) -> bool:
     else:
         return False
 
+def same_content(path_one: Path, path_two: Path, chunk_size: int = CHUNK_SIZE) -> bool:
+    # sizes are compared first, so most different files are never read
+    if os.stat(path_one).st_size != os.stat(path_two).st_size:
+        return False
+
+    with open(path_one, 'rb', buffering=0) as f_one, open(path_two, 'rb', buffering=0) as f_two:
+        while True:
+            chunk_one = f_one.read(chunk_size)
+            chunk_two = f_two.read(chunk_size)
+            if chunk_one != chunk_two:
+                return False
+            if not chunk_one:
+                return True
+
+def bounded_map(fn, items, workers: int = 4):
+    # yields (item, fn(item)) as they finish; at most two items per worker are
+    # queued, so memory stays around workers * 2 * chunk_size however many files there are
+    pending = dict()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for item in items:
+            pending[executor.submit(fn, item)] = item
+            if len(pending) >= workers * 2:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield pending.pop(future), future.result()
+        for future in as_completed(list(pending)):
+            yield pending.pop(future), future.result()
+
+def find_content_mismatches(items, parent_one: Path, parent_two: Path,
+                            workers: int = 4, chunk_size: int = CHUNK_SIZE) -> list:
+    def same(item):
+        # the is_file checks stat both sides, so they run in the workers too;
+        # folders and anything else that is not a file on both sides is not compared
+        path_one, path_two = parent_one / item, parent_two / item
+        if not (path_one.is_file() and path_two.is_file()):
+            return True
+        return same_content(path_one, path_two, chunk_size)
+
+    return [item for item, is_same in bounded_map(same, items, workers) if not is_same]
+
+def file_digest(path: Path, chunk_size: int = CHUNK_SIZE) -> bytes:
+    import hashlib
+    digest = hashlib.new(SNAPSHOT_HASH)
+    with open(path, 'rb', buffering=0) as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+
+    return digest.digest()
+
+def snapshot_paths(dir, scan_workers: int = 1):
+    # the folders and regular files of dir, with the stat results the scan
+    # took. Broken symlinks, entries removed during the walk, sockets, pipes
+    # and devices are left out of snapshots, and reported
+    stats = dict()
+    path_set, parent = find_all_paths(dir, scan_workers, stats)
+    kept = {item: st for item, st in stats.items()
+            if st and (stat.S_ISDIR(st.st_mode) or stat.S_ISREG(st.st_mode))}
+    skipped = sorted(path_set - kept.keys())
+    if skipped:
+        logging.warning(f'Not a folder or a readable file, left out: {skipped}')
+
+    return kept, parent
+
+def snapshot_digest(path: Path, chunk_size: int = CHUNK_SIZE):
+    # None for a file that went away or cannot be read since the walk
+    try:
+        return file_digest(path, chunk_size)
+    except OSError as e:
+        logging.warning(f'Cannot read {path}: {e}')
+        return None
+
+def write_snapshot(dir, snapshot, workers: int = 4, chunk_size: int = CHUNK_SIZE,
+                   scan_workers: int = 1) -> None:
+    import sqlite3
+    stats, parent = snapshot_paths(dir, scan_workers)
+    rows = dict()
+
+    for item, st in stats.items():
+        is_dir = stat.S_ISDIR(st.st_mode)
+        rows[item] = [item, is_dir, None if is_dir else st.st_size,
+                      None if is_dir else st.st_mtime_ns, None]
+
+    file_items = [item for item in rows if not rows[item][1]]
+    digest = lambda item: snapshot_digest(parent / item, chunk_size)
+    for done, (item, item_digest) in enumerate(bounded_map(digest, file_items, workers), start=1):
+        if item_digest is None:
+            del rows[item]
+        else:
+            rows[item][4] = item_digest
+        if done % 10000 == 0:
+            print(f'hashed {done}/{len(file_items)} files')
+
+    conn = sqlite3.connect(snapshot)
+    with conn:
+        conn.execute('DROP TABLE IF EXISTS meta')
+        conn.execute('DROP TABLE IF EXISTS files')
+        conn.execute('CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)')
+        conn.execute('''CREATE TABLE files (path TEXT PRIMARY KEY, is_dir INTEGER,
+                        size INTEGER, mtime INTEGER, digest BLOB) WITHOUT ROWID''')
+        conn.executemany('INSERT INTO meta VALUES (?, ?)',
+                         [('hash', SNAPSHOT_HASH), ('directory', str(Path(dir).resolve()))])
+        conn.executemany('INSERT INTO files VALUES (?, ?, ?, ?, ?)',
+                         (rows[item] for item in sorted(rows)))
+    conn.close()
+    print(f'Snapshot of {len(rows)} paths in {dir} written to {snapshot}')
+
+def compare_to_snapshot(dir, snapshot, workers: int = 4, chunk_size: int = CHUNK_SIZE,
+                        scan_workers: int = 1):
+    import sqlite3
+    stats, parent = snapshot_paths(dir, scan_workers)
+    path_set = set(stats)
+
+    conn = sqlite3.connect(f'file:{snapshot}?mode=ro', uri=True)
+    meta = dict(conn.execute('SELECT key, value FROM meta'))
+    if meta.get('hash') != SNAPSHOT_HASH:
+        sys.exit(f'{snapshot} uses {meta.get("hash")} checksums, expected {SNAPSHOT_HASH}')
+    recorded = {row[0]: row[1:] for row in
+                conn.execute('SELECT path, is_dir, size, mtime, digest FROM files')}
+    conn.close()
+
+    difference = path_set.symmetric_difference(recorded.keys())
+    mismatch_ls = list()
+    to_hash = list()
+
+    for item in path_set & recorded.keys():
+        is_dir, size, mtime, item_digest = recorded[item]
+        st = stats[item]
+        if is_dir != stat.S_ISDIR(st.st_mode):
+            mismatch_ls.append(item)
+        elif not is_dir:
+            if st.st_size != size:
+                mismatch_ls.append(item)
+            elif st.st_mtime_ns != mtime:
+                to_hash.append(item)
+
+    print(f'{len(to_hash)} files changed modification time since the snapshot, checking their contents')
+    digest = lambda item: snapshot_digest(parent / item, chunk_size)
+    for item, item_digest in bounded_map(digest, to_hash, workers):
+        if item_digest != recorded[item][3]:
+            mismatch_ls.append(item)
+
+    return difference, mismatch_ls
+
 def main():
     parser = _make_parser()
     args = parser.parse_args()
 
-    dir_one_set, parent_one = find_all_paths(args.directory_one)
-    dir_two_set, parent_two = find_all_paths(args.directory_two)
+    if args.write_snapshot:
+        write_snapshot(args.directory_one, args.write_snapshot, args.workers, args.chunk_size,
+                       args.scan_workers)
+        return
+
+    if args.snapshot:
+        difference, mismatch_ls = compare_to_snapshot(args.directory_one, args.snapshot,
+                                                      args.workers, args.chunk_size,
+                                                      args.scan_workers)
+        if difference:
+            print(f"""Difference:
+              {difference}
+                """)
+            logging.error(f'The directory is different from the snapshot')
+        if mismatch_ls:
+            logging.error(f'Mismatch: {mismatch_ls}')
+        if not difference and not mismatch_ls:
+            print(f'The directory is the same as the snapshot')
+        return
+
+    if not args.directory_two:
+        parser.error('the following arguments are required: -d_two/--directory_two')
+
+    dir_one_set, parent_one = find_all_paths(args.directory_one, args.scan_workers)
+    dir_two_set, parent_two = find_all_paths(args.directory_two, args.scan_workers)
 
 
     print(f'''Direcotry one set:
@@ -72,13 +307,17 @@ def main():
         logging.error(f'These two directories are different')
     else:
         print('These two directories are the same, now compare files')
-        mismatch_ls = list()
-        for item in dir_one_set:
-            item_one_path = parent_one / item
-            item_two_path = parent_two / item
-            if item_one_path.is_file() and item_two_path.is_file():
-                if not filecmp.cmp(item_one_path, item_two_path, shallow=True):
-                    mismatch_ls.append(item)
+        if args.content:
+            mismatch_ls = find_content_mismatches(dir_one_set, parent_one, parent_two,
+                                                  args.workers, args.chunk_size)
+        else:
+            mismatch_ls = list()
+            for item in dir_one_set:
+                item_one_path = parent_one / item
+                item_two_path = parent_two / item
+                if item_one_path.is_file() and item_two_path.is_file():
+                    if not filecmp.cmp(item_one_path, item_two_path, shallow=True):
+                        mismatch_ls.append(item)
         if mismatch_ls:
             logging.error(f'Mismatch: {mismatch_ls}')
         else:
@@ -0,0 +1,177 @@
+'''
+Compact on-disk payload manifests for bags with millions of files.
+
+A manifest is parsed once into a store file: its payload entries sorted
+by path, the paths packed into one UTF-8 blob and the checksums kept as
+fixed-width binary digests. The store is memory-mapped when it is reused,
+and rebuilt when the size or modification time of the manifest changes.
+Two stores are diffed with a streaming merge, so comparing two bags holds
+only their differences in memory, not two dicts of every file.
+
+Layout, in native byte order as the store is a local cache:
+    header    magic, digest size, entry count, manifest size and mtime
+    offsets   count + 1 uint64, where each path starts in the path blob
+    digests   count * digest size bytes
+    paths     UTF-8 paths, in sorted order
+'''
+
+import mmap
+import os
+import struct
+from array import array
+from pathlib import Path
+from typing import Iterator, Optional
+
+MAGIC = b'BAGMAN01'
+HEADER = struct.Struct('=8sI4xQQq')
+PREFERRED_ALGORITHMS = ['sha512', 'sha256', 'sha1', 'md5']
+
+def manifest_algorithms(bag_path) -> list:
+    return sorted(name[len('manifest-'):-len('.txt')] for name in os.listdir(bag_path)
+                  if name.startswith('manifest-') and name.endswith('.txt'))
+
+def shared_algorithm(bag_one, bag_two) -> Optional[str]:
+    # the strongest algorithm both bags have a payload manifest for
+    shared = set(manifest_algorithms(bag_one)) & set(manifest_algorithms(bag_two))
+    for alg in PREFERRED_ALGORITHMS:
+        if alg in shared:
+            return alg
+    return min(shared) if shared else None
+
+def parse_manifest(manifest: Path) -> list:
+    # lines are read the way bagit reads them, so paths match payload_entries()
+    entries = dict()
+    with open(manifest, encoding='utf-8-sig') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            parts = line.split(None, 1)
+            if len(parts) != 2:
+                continue
+            path = os.path.normpath(parts[1].lstrip('*'))
+            path = path.replace('%0D', '\r').replace('%0A', '\n')
+            if path.startswith('data' + os.sep):
+                entries.setdefault(path.encode('utf-8'), bytes.fromhex(parts[0]))
+
+    return sorted(entries.items())
+
+def write_store(manifest: Path, store_path: Path) -> None:
+    st = os.stat(manifest)
+    entries = parse_manifest(manifest)
+    digest_size = len(entries[0][1]) if entries else 0
+    if any(len(digest) != digest_size for _, digest in entries):
+        raise ValueError(f'{manifest} has checksums of different lengths')
+
+    offsets = array('Q', [0])
+    for path, _ in entries:
+        offsets.append(offsets[-1] + len(path))
+
+    # written next to the store and moved over it, so a reader never sees half a file
+    tmp_path = store_path.with_name(store_path.name + '.tmp')
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, digest_size, len(entries), st.st_size, st.st_mtime_ns))
+        offsets.tofile(f)
+        for _, digest in entries:
+            f.write(digest)
+        for path, _ in entries:
+            f.write(path)
+    os.replace(tmp_path, store_path)
+
+class ManifestStore:
+    def __init__(self, store_path):
+        with open(store_path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, self.digest_size, self.count, self.manifest_size, self.manifest_mtime = \
+                HEADER.unpack_from(self._mm)
+        except struct.error:
+            magic = None
+        if magic != MAGIC:
+            self._mm.close()
+            raise ValueError(f'{store_path} is not a manifest store')
+
+        view = memoryview(self._mm)
+        start = HEADER.size
+        end = start + 8 * (self.count + 1)
+        self._offsets = view[start:end].cast('Q')
+        self._digests = view[end:end + self.count * self.digest_size]
+        self._paths = view[end + self.count * self.digest_size:]
+        self._views = [view, self._offsets, self._digests, self._paths]
+
+    def __len__(self) -> int:
+        return self.count
+
+    def path(self, i: int) -> bytes:
+        return bytes(self._paths[self._offsets[i]:self._offsets[i + 1]])
+
+    def digest(self, i: int) -> bytes:
+        return bytes(self._digests[i * self.digest_size:(i + 1) * self.digest_size])
+
+    def same_entries(self, other: 'ManifestStore') -> bool:
+        # whole columns are compared at once, which is the common case of identical bags
+        return (self.count == other.count and self.digest_size == other.digest_size and
+                self._offsets == other._offsets and self._digests == other._digests and
+                self._paths == other._paths)
+
+    def close(self) -> None:
+        # views into the map have to go before the map itself
+        for view in reversed(self._views):
+            view.release()
+        self._mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def open_store(bag_path, alg: str, store_dir) -> ManifestStore:
+    # one store per bag and algorithm, named after the bag's full path so a
+    # main and a duplicate bag with the same ID do not share a store
+    import hashlib
+    bag_path = Path(bag_path)
+    manifest = bag_path / f'manifest-{alg}.txt'
+    key = hashlib.sha1(str(bag_path.resolve()).encode('utf-8')).hexdigest()[:16]
+    store_path = Path(store_dir) / f'{bag_path.name}-{key}-{alg}.store'
+    st = os.stat(manifest)
+
+    if store_path.is_file():
+        try:
+            store = ManifestStore(store_path)
+        except (OSError, ValueError):
+            store = None
+        if store and (store.manifest_size, store.manifest_mtime) == (st.st_size, st.st_mtime_ns):
+            return store
+        if store:
+            store.close()
+
+    Path(store_dir).mkdir(parents=True, exist_ok=True)
+    write_store(manifest, store_path)
+    return ManifestStore(store_path)
+
+def diff_stores(main: ManifestStore, dup: ManifestStore) -> Iterator[tuple]:
+    # both stores are sorted by path, so one pass over each finds every
+    # difference, yielded as ('missing' | 'extra' | 'mismatched', path)
+    if main.same_entries(dup):
+        return
+
+    i = j = 0
+    while i < len(main) and j < len(dup):
+        main_path, dup_path = main.path(i), dup.path(j)
+        if main_path == dup_path:
+            if main.digest(i) != dup.digest(j):
+                yield 'mismatched', main_path.decode('utf-8')
+            i += 1
+            j += 1
+        elif main_path < dup_path:
+            yield 'missing', main_path.decode('utf-8')
+            i += 1
+        else:
+            yield 'extra', dup_path.decode('utf-8')
+            j += 1
+
+    for i in range(i, len(main)):
+        yield 'missing', main.path(i).decode('utf-8')
+    for j in range(j, len(dup)):
+        yield 'extra', dup.path(j).decode('utf-8')
@@ -1,15 +1,23 @@
 #!/usr/bin/env python3
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-import subprocess
 import re
 import json
 import logging
+import threading
+import time
 
 logging.basicConfig(level=logging.INFO)
 LOGGER = logging.getLogger(__name__)
 
+BUCKET = 'ami-carnegie-servicecopies'
+MEDIA_EXTS = ['.mp4', '.wav', '.flac']
+AMI_ID = re.compile(r'\d{6}')
+FN_CONVENTION = re.compile(r'(\w{3}_\d{6}_\w+_(sc|em))')
+BARCODE_PREFIX = re.compile(r'33433')
+
 
 def get_args():
     parser = argparse.ArgumentParser(description='''Upload access copies and JSON
@@ -36,6 +44,49 @@ def get_args():
                         are in the AWS bucket; check if there is any filename or
                         metadata mismatch;and upload ONLY the valid ones not in
                         the AWS bucket''')
+    parser.add_argument('--endpoint_url',
+                        help=f'''optional. Send AWS requests to this URL instead
+                        of AWS, e.g. a local MinIO for testing''')
+    parser.add_argument('--uploads',
+                        type=int,
+                        default=4,
+                        help=f'''optional. Number of files uploaded at the same
+                        time. Default 4''')
+    parser.add_argument('--multipart_chunksize',
+                        type=int,
+                        default=64,
+                        help=f'''optional. Size in MB of each part of a multipart
+                        upload; files larger than this are uploaded in parts.
+                        Default 64''')
+    parser.add_argument('--multipart_concurrency',
+                        type=int,
+                        default=4,
+                        help=f'''optional. Number of parts of one file uploaded
+                        at the same time. Default 4''')
+    parser.add_argument('--retries',
+                        type=int,
+                        default=3,
+                        help=f'''optional. Number of times a failed upload is
+                        tried again, waiting longer each time. Default 3''')
+    parser.add_argument('--workers',
+                        type=int,
+                        default=8,
+                        help=f'''optional. Number of items validated at the same
+                        time. Default 8''')
+    parser.add_argument('--validation_report',
+                        help=f'''optional. A JSON lines file to write the validation
+                        result of every item to, with the rules it failed''')
+    parser.add_argument('--journal',
+                        help=f'''optional. A JSON lines file that records the state
+                        of every file as the run goes. A rerun with the same journal
+                        skips items already in the bucket or uploaded, as long as
+                        their files have not changed since''')
+    parser.add_argument('--orphan_report',
+                        help=f'''optional. A JSON file to write the files that could
+                        not be paired to, e.g. media without JSON''')
+    parser.add_argument('--upload_report',
+                        help=f'''optional. A JSON lines file to write the result of
+                        every upload to''')
     args = parser.parse_args()
     return args
 
@@ -46,48 +97,76 @@ def validate_dir(dir: Path) -> bool:
     else:
         return False
 
-def get_ami_dict(filepaths: list) -> dict:
+def pair_ami_files(filepaths: list) -> tuple:
+    # media and JSON are paired on their stem through a dict, in one pass
+    # over each; anything that cannot be paired to one ID is an orphan
     ami_dict = dict()
-    expected = r'\d{6}'
-    media_exts = ['.mp4', '.wav', '.flac']
-    media_paths = [x for x in filepaths if x.suffix.lower() in media_exts]
-    json_paths = [x for x in filepaths if x.suffix.lower() == '.json']
+    orphans = {'media_without_json': [],
+               'json_without_media': [],
+               'media_without_id': [],
+               'duplicate_ids': dict()}
+    media_paths = [x for x in filepaths if x.suffix.lower() in MEDIA_EXTS]
+    json_by_stem = {x.stem: x for x in filepaths if x.suffix.lower() == '.json'}
+    paired_stems = set()
+    pairs_by_id = dict()
 
     for media_p in media_paths:
-        filename = media_p.stem
-        for json_p in json_paths:
-            if json_p.stem == filename:
-                id = re.search(expected, media_p.stem).group(0)
-                if id:
-                    ami_dict[id] = [media_p, json_p]
+        json_p = json_by_stem.get(media_p.stem)
+        if not json_p:
+            orphans['media_without_json'].append(str(media_p))
+            continue
+        paired_stems.add(media_p.stem)
+        match = AMI_ID.search(media_p.stem)
+        if not match:
+            orphans['media_without_id'].append(str(media_p))
+            continue
+        pairs_by_id.setdefault(match.group(0), []).append([media_p, json_p])
+
+    for stem, json_p in json_by_stem.items():
+        if not stem in paired_stems:
+            orphans['json_without_media'].append(str(json_p))
 
+    # an ID with more than one media file is left out, rather than picking one
+    for id, pairs in pairs_by_id.items():
+        if len(pairs) > 1:
+            orphans['duplicate_ids'][id] = [str(media_p) for media_p, _ in pairs]
+        else:
+            ami_dict[id] = pairs[0]
+
+    return ami_dict, orphans
+
+def get_ami_dict(filepaths: list) -> dict:
+    ami_dict, _ = pair_ami_files(filepaths)
     return ami_dict
 
 def validate_filename(filepath: Path) -> bool:
-    fn_convention = r'(\w{3}_\d{6}_\w+_(sc|em))'
-    match = re.fullmatch(fn_convention, filepath.stem)
+    match = FN_CONVENTION.fullmatch(filepath.stem)
     if match:
         return True
     else:
         LOGGER.warning(f'{filepath.stem} filenaming incorrect')
         return False
 
-def validate_json_ref_filename(media_p: Path, json_p: Path) -> bool:
+def load_json(json_p: Path) -> dict:
     with open(json_p, "r", encoding='utf-8-sig') as jsonFile:
-        data = json.load(jsonFile)
-        json_name = data['asset']['referenceFilename']
+        return json.load(jsonFile)
+
+def validate_json_ref_filename(media_p: Path, json_p: Path, data: dict = None) -> bool:
+    if data is None:
+        data = load_json(json_p)
+    json_name = data['asset']['referenceFilename']
     if json_name == media_p.name:
         return True
     else:
         LOGGER.warning(f'{json_name} and {media_p.name} are different')
         return False
 
-def validate_json_barcode(json_p: Path) -> bool:
-    with open(json_p, "r", encoding='utf-8-sig') as jsonFile:
-        data = json.load(jsonFile)
-        barcode = data['bibliographic']['barcode']
-        match = re.match(r'33433', barcode)
-        # re.match() matches the beginning of the string
+def validate_json_barcode(json_p: Path, data: dict = None) -> bool:
+    if data is None:
+        data = load_json(json_p)
+    barcode = data['bibliographic']['barcode']
+    match = BARCODE_PREFIX.match(barcode)
+    # re.match() matches the beginning of the string
 
     if match:
         return True
@@ -95,51 +174,241 @@ def validate_json_barcode(json_p: Path) -> bool:
         LOGGER.warning(f'{barcode} is incorrect')
         return False
 
-def absent_in_bucket(filepath: Path) -> Path:
-    absent = ''
-    check_cmd = ['aws', 's3api', 'head-object',
-                '--bucket', 'ami-carnegie-servicecopies',
-                '--key', '']
+def validate_item(ami_key: str, media_p: Path, json_p: Path) -> dict:
+    # the JSON is parsed once and shared by both JSON rules; every rule runs,
+    # so the result lists all the rules the item failed
+    result = {'id': ami_key, 'media': str(media_p), 'json': str(json_p),
+              'valid': False, 'failed': []}
+
+    if not validate_filename(media_p):
+        result['failed'].append('media_filename')
+    if not validate_filename(json_p):
+        result['failed'].append('json_filename')
+
+    try:
+        data = load_json(json_p)
+    except (OSError, ValueError) as e:
+        LOGGER.warning(f'{json_p.name} cannot be read: {e}')
+        result['failed'].append('json_readable')
+    else:
+        rules = [
+            ('json_ref_filename', lambda: validate_json_ref_filename(media_p, json_p, data)),
+            ('json_barcode', lambda: validate_json_barcode(json_p, data))
+        ]
+        for name, rule in rules:
+            try:
+                if not rule():
+                    result['failed'].append(name)
+            except (KeyError, TypeError, AttributeError) as e:
+                LOGGER.warning(f'{json_p.name} is missing the field for {name}: {e}')
+                result['failed'].append(name)
+
+    result['valid'] = not result['failed']
+    return result
+
+def validate_items(ami_dict: dict, workers: int = 8) -> list:
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(lambda ami_key: validate_item(ami_key, *ami_dict[ami_key]),
+                                 ami_dict))
+
+def list_bucket_keys(endpoint_url: str = None) -> set:
+    from botocore.exceptions import BotoCoreError, ClientError
+
+    LOGGER.info(f'Now listing all keys in {BUCKET}')
+    # list_objects_v2 returns at most 1000 keys a page; the paginator follows the pages
+    paginator = make_s3_client(endpoint_url).get_paginator('list_objects_v2')
+    keys = set()
+    try:
+        for page in paginator.paginate(Bucket=BUCKET):
+            keys.update(item['Key'] for item in page.get('Contents', []))
+    except (BotoCoreError, ClientError) as e:
+        LOGGER.error(f'Cannot list {BUCKET}: {e}')
+        raise
+    LOGGER.info(f'{len(keys)} keys in {BUCKET}')
+    return keys
+
+def bucket_keys_for(filepath: Path) -> list:
     if filepath.suffix.lower() == '.flac' or filepath.suffix.lower() == '.wav':
-        check_cmd[-1] = filepath.name
-        LOGGER.info(f'Now checking if {filepath.name} is in bucket')
-        output_original_media = subprocess.run(check_cmd,
-                                               capture_output=True).stdout
-        if not output_original_media:
-            mp4_key = filepath.name.replace('flac', 'mp4').replace('wav', 'mp4')
-            check_cmd[-1] = mp4_key
-            LOGGER.info(f'Now checking if {mp4_key} is in bucket')
-            output_mp4 = subprocess.run(check_cmd, capture_output=True).stdout
-            if not output_mp4:
-                LOGGER.warning(f'{filepath.name} not in the bucket')
-                absent = filepath
-    elif filepath.suffix.lower() == '.mp4':
-        check_cmd[-1] = filepath.name
-        LOGGER.info(f'Now checking if {filepath.name} is in bucket')
-        output_mp4_media = subprocess.run(check_cmd,
-                                               capture_output=True).stdout
-        if not output_mp4_media:
-            LOGGER.warning(f'{filepath.name} not in the bucket')
-            absent = filepath
-    elif filepath.suffix.lower() == '.json':
-        check_cmd[-1] = filepath.name
-        LOGGER.info(f'Now checking if {filepath.name} is in bucket')
-        output_json_mp4 = subprocess.run(check_cmd, capture_output=True).stdout
-        if not output_json_mp4:
-            LOGGER.warning(f'{filepath.name} not in the bucket')
-            absent = filepath
+        mp4_key = filepath.name.replace('flac', 'mp4').replace('wav', 'mp4')
+        return [filepath.name, mp4_key]
+    elif filepath.suffix.lower() in ['.mp4', '.json']:
+        return [filepath.name]
+    return []
+
+def in_bucket(key: str, bucket_keys: set = None, endpoint_url: str = None) -> bool:
+    if bucket_keys is not None:
+        return key in bucket_keys
+    from botocore.exceptions import ClientError
+
+    LOGGER.info(f'Now checking if {key} is in bucket')
+    try:
+        make_s3_client(endpoint_url).head_object(Bucket=BUCKET, Key=key)
+    except ClientError as e:
+        # any other error counts as absent too, as the key could not be seen
+        if e.response['Error']['Code'] not in ('404', 'NoSuchKey', 'NotFound'):
+            LOGGER.warning(f'Cannot check {key} in {BUCKET}: {e}')
+        return False
+    return True
+
+def absent_in_bucket(filepath: Path, bucket_keys: set = None,
+                     endpoint_url: str = None) -> Path:
+    # with bucket_keys from list_bucket_keys, no request is made per file;
+    # without it, each key is checked with head-object
+    absent = ''
+    keys = bucket_keys_for(filepath)
+    # a flac or wav counts as present when its mp4 service copy is there
+    if keys and not any(in_bucket(key, bucket_keys, endpoint_url) for key in keys):
+        LOGGER.warning(f'{filepath.name} not in the bucket')
+        absent = filepath
 
     return absent
 
-def cp_files(filepaths: list) -> None:
-    for file in filepaths:
-        cp_command = [
-            'aws', 's3', 'cp',
-            file,
-            's3://ami-carnegie-servicecopies'
-            ]
-        print(cp_command)
-        subprocess.call(cp_command)
+def make_s3_client(endpoint_url: str = None, max_pool_connections: int = 10):
+    # boto3 is only needed for uploading, so it is imported here
+    import boto3
+    from botocore.config import Config
+
+    config = Config(retries={'mode': 'standard'},
+                    max_pool_connections=max_pool_connections)
+    return boto3.client('s3', endpoint_url=endpoint_url, config=config)
+
+def upload_file(s3, transfer_config, filepath: Path, retries: int = 3) -> dict:
+    from boto3.exceptions import S3UploadFailedError
+    from botocore.exceptions import BotoCoreError, ClientError
+
+    result = {'file': str(filepath), 'key': filepath.name, 'status': 'failed',
+              'size': None, 'etag': None, 'attempts': 0,
+              'seconds': 0.0, 'error': None}
+    start = time.monotonic()
+
+    # a file that cannot be read fails on its own, and the batch goes on
+    try:
+        result['size'] = filepath.stat().st_size
+    except OSError as e:
+        result['error'] = str(e)
+        LOGGER.error(f'Could not upload {filepath.name}: {e}')
+        return result
+
+    for attempt in range(retries + 1):
+        result['attempts'] = attempt + 1
+        try:
+            s3.upload_file(str(filepath), BUCKET, filepath.name,
+                           Config=transfer_config)
+            head = s3.head_object(Bucket=BUCKET, Key=filepath.name)
+            result['status'] = 'uploaded'
+            result['etag'] = head['ETag'].strip('"')
+            result['error'] = None
+            break
+        except (S3UploadFailedError, BotoCoreError, ClientError) as e:
+            result['error'] = str(e)
+            if attempt < retries:
+                wait = 2 ** attempt
+                LOGGER.warning(f'Uploading {filepath.name} failed, trying again in {wait}s: {e}')
+                time.sleep(wait)
+        except OSError as e:
+            # the local file went away or could not be read; trying again will not help
+            result['error'] = str(e)
+            break
+
+    result['seconds'] = round(time.monotonic() - start, 3)
+    if result['status'] == 'uploaded':
+        LOGGER.info(f'Uploaded {filepath.name} ({result["size"]} bytes) in {result["seconds"]}s')
+    else:
+        LOGGER.error(f'Could not upload {filepath.name}: {result["error"]}')
+    return result
+
+def upload_files(filepaths: list, endpoint_url: str = None, uploads: int = 4,
+                 multipart_chunksize: int = 64, multipart_concurrency: int = 4,
+                 retries: int = 3, on_result=None) -> list:
+    from boto3.s3.transfer import TransferConfig
+
+    if not filepaths:
+        return []
+
+    chunksize = multipart_chunksize * 1024 * 1024
+    transfer_config = TransferConfig(multipart_threshold=chunksize,
+                                     multipart_chunksize=chunksize,
+                                     max_concurrency=multipart_concurrency)
+    # one client is shared by every upload thread, so it needs a connection
+    # for every part that can be in flight at once
+    s3 = make_s3_client(endpoint_url, uploads * multipart_concurrency)
+
+    def upload(filepath):
+        result = upload_file(s3, transfer_config, filepath, retries)
+        if on_result:
+            on_result(result)
+        return result
+
+    with ThreadPoolExecutor(max_workers=uploads) as executor:
+        results = list(executor.map(upload, filepaths))
+
+    uploaded = [r for r in results if r['status'] == 'uploaded']
+    LOGGER.info(f'{len(uploaded)} of {len(results)} files uploaded, '
+                f'{sum(r["size"] for r in uploaded)} bytes')
+    return results
+
+class Journal:
+    # append-only JSON lines, one record per state change of a file;
+    # the last record of a file is its current state
+    COMPLETE = ('present', 'uploaded')
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.states = dict()
+        self.lock = threading.Lock()
+        if self.path.is_file():
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # a line cut short when the last run died
+                        continue
+                    self.states[record['file']] = record
+        self.f = open(self.path, 'a', encoding='utf-8')
+
+    def record(self, filepath: Path, state: str, **details) -> None:
+        try:
+            stat = filepath.stat()
+            size, mtime = stat.st_size, stat.st_mtime_ns
+        except OSError:
+            # a file that went away is recorded without them, and never counts as complete
+            size = mtime = None
+        record = {'file': str(filepath.resolve()), 'state': state,
+                  'size': size, 'mtime': mtime,
+                  'time': time.time(), **details}
+        with self.lock:
+            self.states[record['file']] = record
+            self.f.write(json.dumps(record) + '\n')
+            self.f.flush()
+
+    def is_complete(self, filepath: Path) -> bool:
+        record = self.states.get(str(filepath.resolve()))
+        if not record or not record['state'] in self.COMPLETE:
+            return False
+        stat = filepath.stat()
+        return record['size'] == stat.st_size and record['mtime'] == stat.st_mtime_ns
+
+    def close(self) -> None:
+        self.f.close()
+
+def upload_and_report(filepaths: list, args, journal: Journal = None) -> list:
+    def on_result(result):
+        if journal:
+            journal.record(Path(result['file']), result['status'],
+                           etag=result['etag'], error=result['error'])
+
+    results = upload_files(filepaths, args.endpoint_url, args.uploads,
+                           args.multipart_chunksize, args.multipart_concurrency,
+                           args.retries, on_result)
+    failed = [r['file'] for r in results if r['status'] == 'failed']
+    if failed:
+        LOGGER.error(f'These files were not uploaded: {failed}')
+    if args.upload_report:
+        with open(args.upload_report, 'w', encoding='utf-8') as f:
+            for r in results:
+                f.write(json.dumps(r) + '\n')
+    return results
 
 def main():
     args = get_args()
@@ -147,31 +416,63 @@ def main():
 
     if validate_dir(dir):
         all_filepaths = [x for x in Path(dir).iterdir() if x.is_file()]
-        ami_dict = get_ami_dict(all_filepaths)
+        ami_dict, orphans = pair_ami_files(all_filepaths)
+        orphan_counts = {k: len(v) for k, v in orphans.items() if v}
+        if orphan_counts:
+            LOGGER.warning(f'Files not paired to one ID: {orphan_counts}')
+        if args.orphan_report:
+            Path(args.orphan_report).write_text(json.dumps(orphans, indent=2))
         all_absent_paths = []
+        to_upload = []
+        bucket_keys = None
+
+        journal = None
+        if args.journal:
+            journal = Journal(args.journal)
+            completed = [k for k, pair in ami_dict.items()
+                         if all(journal.is_complete(p) for p in pair)]
+            if completed:
+                LOGGER.info(f'Skipping {len(completed)} items already in the bucket '
+                            f'according to {args.journal}')
+            for ami_key in completed:
+                del ami_dict[ami_key]
 
-        for ami_key in ami_dict:
-            if not len(ami_dict[ami_key]) == 2:
-                LOGGER.error(f'{ami_key} does not have both media and json file')
+        validation = validate_items(ami_dict, args.workers)
+        if not args.direct_upload and any(r['valid'] for r in validation):
+            bucket_keys = list_bucket_keys(args.endpoint_url)
+        if args.validation_report:
+            with open(args.validation_report, 'w', encoding='utf-8') as f:
+                for result in validation:
+                    f.write(json.dumps(result) + '\n')
 
+        for result in validation:
+            ami_key = result['id']
             media_p, json_p = ami_dict[ami_key][0], ami_dict[ami_key][1]
 
-            if (validate_filename(media_p) and
-                validate_filename(json_p) and
-                validate_json_ref_filename(media_p, json_p) and
-                validate_json_barcode(json_p)):
+            if result['valid']:
                 LOGGER.info(f'{ami_key} filenames and JSON all validated')
 
                 if args.direct_upload:
-                    cp_files(ami_dict[ami_key])
+                    to_upload.extend(ami_dict[ami_key])
+                    if journal:
+                        journal.record(media_p, 'validated')
+                        journal.record(json_p, 'validated')
                 else:
-                    ab_media, ab_json = absent_in_bucket(media_p), absent_in_bucket(json_p)
-                    if ab_media:
-                        all_absent_paths.append(ab_media)
-                    if ab_json:
-                        all_absent_paths.append(ab_json)
+                    for p in (media_p, json_p):
+                        if absent_in_bucket(p, bucket_keys):
+                            all_absent_paths.append(p)
+                            if journal:
+                                journal.record(p, 'validated')
+                        elif journal:
+                            journal.record(p, 'present')
             else:
-                LOGGER.warning(f'{ami_key} has file(s) not validated.')
+                LOGGER.warning(f'{ami_key} has file(s) not validated: {result["failed"]}')
+                if journal:
+                    journal.record(media_p, 'failed', error=result['failed'])
+                    journal.record(json_p, 'failed', error=result['failed'])
+
+        if args.direct_upload:
+            upload_and_report(to_upload, args, journal)
 
         if args.check_only:
             if len(all_absent_paths) > 0:
@@ -181,10 +482,13 @@ def main():
 
         if args.check_and_upload:
             if len(all_absent_paths) > 0:
-                cp_files(all_absent_paths)
+                upload_and_report(all_absent_paths, args, journal)
             elif len(all_absent_paths) == 0:
                 LOGGER.info(f'''All validated files are in the bucket.
                               No files to upload''')
 
+        if journal:
+            journal.close()
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
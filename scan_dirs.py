@@ -0,0 +1,88 @@
+'''
+Directory scanning shared by lint_er, compare_paths and compare_bags.
+
+On SMB/NFS mounts every directory listing is a round trip to the server,
+so a walk is bound by latency, not bandwidth. scan_tree lists up to
+`workers` folders at the same time on a thread pool and yields the
+entries in the same breadth-first order however many workers there are.
+'''
+
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator, Optional, Union
+
+def _list_dir(path: str, stat) -> list:
+    # runs on a worker thread; is_dir() and stat() are called here so
+    # DirEntry caches them, and the caller does not wait on the server again
+    with os.scandir(path) as it:
+        entries = list(it)
+    for entry in entries:
+        entry.is_dir()
+        if stat is True or (stat and stat(entry)):
+            try:
+                entry.stat()
+            except OSError:
+                pass
+    return entries
+
+def _walk_into(rel_path: str, entry: os.DirEntry) -> bool:
+    return entry.is_dir(follow_symlinks=False)
+
+def scan_tree(root, workers: int = 1,
+              stat: Union[bool, Callable[[os.DirEntry], bool]] = False,
+              descend: Callable[[str, os.DirEntry], bool] = _walk_into,
+              onerror: Optional[Callable[[str, OSError], None]] = None
+              ) -> Iterator[tuple[str, os.DirEntry]]:
+    '''
+    Yield (relative folder, entry) for every entry below root, where the
+    relative folder is '' for root itself and uses / between parts.
+    stat is True to stat every entry ahead of time, or a function picking
+    the entries to stat. descend(relative path, entry) decides whether a
+    folder is walked into; by default every folder that is not a symlink.
+    An OSError listing a folder is passed to onerror(relative folder,
+    error), and raised if there is no onerror.
+    '''
+    root = os.fspath(root)
+    pending = deque([''])
+
+    def full_path(rel_dir):
+        return os.path.join(root, rel_dir) if rel_dir else root
+
+    def handle(rel_dir, entries):
+        for entry in entries:
+            yield rel_dir, entry
+            rel_path = f'{rel_dir}/{entry.name}' if rel_dir else entry.name
+            if entry.is_dir() and descend(rel_path, entry):
+                pending.append(rel_path)
+
+    if workers <= 1:
+        while pending:
+            rel_dir = pending.popleft()
+            try:
+                entries = _list_dir(full_path(rel_dir), stat)
+            except OSError as e:
+                if not onerror:
+                    raise
+                onerror(rel_dir, e)
+                continue
+            yield from handle(rel_dir, entries)
+        return
+
+    # listings are consumed in the order they were submitted, while up to
+    # two per worker are in flight behind the one being consumed
+    in_flight = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while pending or in_flight:
+            while pending and len(in_flight) < workers * 2:
+                rel_dir = pending.popleft()
+                in_flight.append((rel_dir, executor.submit(_list_dir, full_path(rel_dir), stat)))
+            rel_dir, future = in_flight.popleft()
+            try:
+                entries = future.result()
+            except OSError as e:
+                if not onerror:
+                    raise
+                onerror(rel_dir, e)
+                continue
+            yield from handle(rel_dir, entries)
@@ -0,0 +1,23 @@
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+# the scripts under test are at the top of the repo, next to this folder
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+@pytest.fixture
+def unreadable(monkeypatch):
+    """Make listing the given folders raise PermissionError; chmod does
+    not stop root, who may run the tests, from listing a folder"""
+    folders = set()
+    scandir = os.scandir
+
+    def failing_scandir(path='.'):
+        if os.path.realpath(path) in folders:
+            raise PermissionError(13, 'Permission denied', os.fspath(path))
+        return scandir(path)
+
+    monkeypatch.setattr(os, 'scandir', failing_scandir)
+    return lambda folder: folders.add(os.path.realpath(folder))
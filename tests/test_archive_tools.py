@@ -0,0 +1,39 @@
+import sys
+import pytest
+
+import archive_tools
+
+@pytest.fixture
+def restore_sys(monkeypatch):
+    """run() rewrites sys.argv and may add to sys.path; both are put back"""
+    monkeypatch.setattr(sys, 'argv', list(sys.argv))
+    monkeypatch.setattr(sys, 'path', list(sys.path))
+
+def test_get_args_passes_script_options():
+    """Everything after the command, options included, goes to the script"""
+    args = archive_tools.get_args(['compare-paths', '-d_one', 'one', '--content'])
+
+    assert args.command == 'compare-paths'
+    assert args.args == ['-d_one', 'one', '--content']
+
+def test_run_compare_paths(restore_sys, tmp_path, capsys):
+    """The command's script runs with the options as its own sys.argv"""
+    tmp_path.joinpath('M1234').mkdir()
+    tmp_path.joinpath('M1234', 'file.txt').write_bytes(b'some bytes')
+
+    archive_tools.run('compare-paths', ['-d_one', str(tmp_path / 'M1234'),
+                                        '-d_two', str(tmp_path / 'M1234')])
+
+    assert sys.argv[0] == 'archive-tools compare-paths'
+    assert 'Both directories files are the same' in capsys.readouterr().out
+
+@pytest.mark.parametrize('command', list(archive_tools.COMMANDS))
+def test_run_help(restore_sys, capsys, command):
+    """Every command's script is found, including lint_er in its own folder,
+    and --help is its own help under the archive-tools name"""
+    with pytest.raises(SystemExit) as exit:
+        archive_tools.run(command, ['--help'])
+
+    assert exit.value.code == 0
+    assert f'usage: archive-tools {command}' in capsys.readouterr().out
+    assert archive_tools.COMMANDS[command][1] in sys.path
@@ -0,0 +1,325 @@
+import argparse
+import json
+import os
+import shutil
+import bagit
+import pytest
+from pathlib import Path
+
+import compare_bags
+
+@pytest.fixture
+def bags(tmp_path: Path):
+    """A valid bag in the main directory and an identical copy in the dupe directory"""
+    main_bag = tmp_path.joinpath('main', '123456')
+    main_bag.joinpath('sub').mkdir(parents=True)
+    main_bag.joinpath('file.txt').write_bytes(b'some bytes for the payload')
+    main_bag.joinpath('sub', 'other.txt').write_bytes(b'more bytes')
+    bagit.make_bag(str(main_bag), checksums=['md5'])
+
+    dup_bag = tmp_path.joinpath('dupe', '123456')
+    shutil.copytree(main_bag, dup_bag)
+    return main_bag, dup_bag
+
+def payload_size(bag_path: Path) -> int:
+    return sum(f.stat().st_size for f in bag_path.joinpath('data').rglob('*') if f.is_file())
+
+def test_hardlink_verified_bag(bags):
+    """Every payload file of an identical duplicate becomes a link to the main copy"""
+    main_bag, dup_bag = bags
+    dedup = compare_bags.BagDedup('hardlink')
+
+    reclaimed = dedup(main_bag, dup_bag)
+
+    assert reclaimed == payload_size(dup_bag) == dedup.reclaimed
+    for path in bagit.Bag(str(main_bag)).payload_entries():
+        assert main_bag.joinpath(path).samefile(dup_bag / path)
+
+def test_hardlink_again_reclaims_nothing(bags):
+    """Files that already are links to the main copy are not counted twice"""
+    main_bag, dup_bag = bags
+    dedup = compare_bags.BagDedup('hardlink')
+    dedup(main_bag, dup_bag)
+
+    assert dedup(main_bag, dup_bag) == 0
+
+def test_hardlink_refuses_extra_file(bags):
+    """A duplicate with a payload file not in its manifest is left alone"""
+    main_bag, dup_bag = bags
+    dup_bag.joinpath('data', 'extra.txt').write_bytes(b'not in the manifest')
+    dedup = compare_bags.BagDedup('hardlink')
+
+    assert dedup(main_bag, dup_bag) is None
+    assert dedup.reclaimed == 0
+    assert not main_bag.joinpath('data', 'file.txt').samefile(dup_bag / 'data' / 'file.txt')
+
+def test_hardlink_refuses_different_file(bags):
+    """A duplicate whose bytes differ from the main copy is left alone,
+    even though its manifest is the same"""
+    main_bag, dup_bag = bags
+    dup_file = dup_bag / 'data' / 'sub' / 'other.txt'
+    dup_file.write_bytes(b'MORE bytes')
+    dedup = compare_bags.BagDedup('hardlink')
+
+    assert dedup(main_bag, dup_bag) is None
+    assert dedup.reclaimed == 0
+    assert dup_file.read_bytes() == b'MORE bytes'
+
+def test_plan_verified_bag(monkeypatch, tmp_path, bags):
+    """The plan deletes the whole duplicate bag by its absolute path,
+    and changes nothing itself"""
+    main_bag, dup_bag = bags
+    monkeypatch.chdir(tmp_path)
+    plan = tmp_path / 'plan.sh'
+    dedup = compare_bags.BagDedup('plan', plan)
+
+    reclaimed = dedup(main_bag, Path('dupe', '123456'))
+    dedup.close()
+
+    bag_size = sum(f.stat().st_size for f in dup_bag.rglob('*') if f.is_file())
+    assert reclaimed == bag_size == dedup.reclaimed
+    lines = plan.read_text(encoding='utf-8').splitlines()
+    assert f'rm -r -- {dup_bag.resolve()}' in lines
+    assert f'# 123456: {bag_size} bytes, same as {main_bag.resolve()}' in lines
+    assert dup_bag.joinpath('data', 'file.txt').is_file()
+
+def test_plan_refuses_different_file(tmp_path, bags):
+    """A duplicate whose bytes differ from the main copy is not in the plan"""
+    main_bag, dup_bag = bags
+    dup_bag.joinpath('data', 'file.txt').write_bytes(b'SOME bytes for the payload')
+    plan = tmp_path / 'plan.sh'
+    dedup = compare_bags.BagDedup('plan', plan)
+
+    assert dedup(main_bag, dup_bag) is None
+    dedup.close()
+
+    assert dedup.reclaimed == 0
+    assert 'rm -r' not in plan.read_text(encoding='utf-8')
+
+def audit(bag_path: Path, checkpoint_path: Path) -> dict:
+    checkpoint = compare_bags.AuditCheckpoint(checkpoint_path)
+    progress = compare_bags.AuditProgress(0, every=3600)
+    try:
+        compare_bags.audit_bag(bagit.Bag(str(bag_path)), checkpoint,
+                               compare_bags.Throttle(), progress, workers=2)
+        return checkpoint.finish_bag(bag_path.name)
+    finally:
+        checkpoint.close()
+
+def test_audit_valid_bag(tmp_path, bags):
+    """Every payload file is hashed and counted with its size"""
+    main_bag, _ = bags
+    result = audit(main_bag, tmp_path / 'audit.sqlite')
+
+    assert result == {'files': 2, 'missing': [], 'mismatched': [],
+                      'unreadable': [], 'extra': [], 'error': None, 'status': 'valid'}
+
+def test_audit_records_unreadable_file(tmp_path, bags):
+    """A file that cannot be read is recorded as unreadable, and the rest
+    of the bag is still audited"""
+    main_bag, _ = bags
+    main_bag.joinpath('data', 'file.txt').unlink()
+    main_bag.joinpath('data', 'file.txt').mkdir()
+    main_bag.joinpath('data', 'sub', 'other.txt').write_bytes(b'MORE bytes')
+
+    result = audit(main_bag, tmp_path / 'audit.sqlite')
+
+    assert result == {'files': 2, 'missing': [], 'mismatched': ['data/sub/other.txt'],
+                      'unreadable': ['data/file.txt'], 'extra': [], 'error': None,
+                      'status': 'invalid'}
+
+def test_audit_records_extra_file(tmp_path, bags):
+    """A payload file that no manifest lists makes the bag invalid, as it
+    does for bagit's validate"""
+    main_bag, _ = bags
+    main_bag.joinpath('data', 'sub', 'extra.txt').write_bytes(b'not in the manifest')
+
+    result = audit(main_bag, tmp_path / 'audit.sqlite')
+
+    assert result == {'files': 2, 'missing': [], 'mismatched': [], 'unreadable': [],
+                      'extra': ['data/sub/extra.txt'], 'error': None, 'status': 'invalid'}
+    with pytest.raises(bagit.BagValidationError):
+        bagit.Bag(str(main_bag)).validate()
+
+def test_dedup_refuses_main_copy(tmp_path, bags):
+    """A bag is never deduplicated against itself, however it is reached"""
+    main_bag, _ = bags
+    plan = tmp_path / 'plan.sh'
+    dedup = compare_bags.BagDedup('plan', plan)
+    tmp_path.joinpath('alias').symlink_to(main_bag.parent)
+
+    assert dedup(main_bag, main_bag) is None
+    assert dedup(main_bag, tmp_path / 'alias' / '123456') is None
+    assert dedup(main_bag, main_bag / 'data') is None
+    dedup.close()
+
+    assert dedup.reclaimed == 0
+    assert 'rm -r' not in plan.read_text(encoding='utf-8')
+
+@pytest.mark.parametrize('dupe', ['main', 'main/inner', '.'])
+def test_main_rejects_overlapping_directories(monkeypatch, tmp_path, bags, dupe):
+    """-d_dupe and -d_main that are the same or nested are refused before anything runs"""
+    tmp_path.joinpath('main', 'inner').mkdir()
+    plan = tmp_path / 'plan.sh'
+    monkeypatch.setattr('sys.argv', ['compare_bags.py', '-d_dupe', str(tmp_path / dupe),
+                                     '-d_main', str(tmp_path / 'main'),
+                                     '--dedup', 'plan', '--dedup_plan', str(plan)])
+
+    with pytest.raises(SystemExit):
+        compare_bags.main()
+    assert not plan.exists()
+
+def test_index_bags_skips_unreadable_folder(tmp_path, bags, unreadable):
+    """Bags in the folders that can be listed are indexed"""
+    main_bag, _ = bags
+    tmp_path.joinpath('main', 'g').mkdir()
+    main_bag.rename(tmp_path / 'main' / 'g' / '123456')
+    tmp_path.joinpath('main', 'h', '654321').mkdir(parents=True)
+    unreadable(tmp_path / 'main' / 'g')
+
+    index = compare_bags.index_bags(tmp_path / 'main')
+
+    assert index['bags'] == {'654321': 'h/654321'}
+
+def test_bag_index_reused_until_a_folder_changes(monkeypatch, tmp_path, bags):
+    """The index file is used as long as the folders above the bags are
+    unchanged; a new bag makes it out of date and it is rebuilt"""
+    main_bag, _ = bags
+    main = tmp_path / 'main'
+    main.joinpath('g').mkdir()
+    main_bag.rename(main / 'g' / '123456')
+    index_file = tmp_path / 'index.json'
+    index_bags = compare_bags.index_bags
+    walks = []
+    monkeypatch.setattr(compare_bags, 'index_bags',
+                        lambda *args: walks.append(args) or index_bags(*args))
+
+    first = compare_bags.load_bag_index(main, index_file)
+    again = compare_bags.load_bag_index(main, index_file)
+    main.joinpath('g', '654321').mkdir()
+    os.utime(main / 'g', ns=(0, 0))
+    rebuilt = compare_bags.load_bag_index(main, index_file)
+
+    assert len(walks) == 2
+    assert first == again
+    assert first['bags'] == {'123456': 'g/123456'}
+    assert rebuilt['bags'] == {'123456': 'g/123456', '654321': 'g/654321'}
+    assert json.loads(index_file.read_text()) == rebuilt
+
+@pytest.mark.parametrize('content', ['{"bags": ', '{"version": 0, "dirs": {}, "bags": {}}'])
+def test_bag_index_rebuilt_when_unusable(tmp_path, bags, content):
+    """An index file cut short, or written by another version, is rebuilt"""
+    index_file = tmp_path / 'index.json'
+    index_file.write_text(content)
+
+    index = compare_bags.load_bag_index(tmp_path / 'main', index_file)
+
+    assert index['bags'] == {'123456': '123456'}
+    assert json.loads(index_file.read_text()) == index
+
+@pytest.mark.parametrize('fixity', [False, True])
+def test_validate_bags_in_main_workers(tmp_path, bags, fixity):
+    """Bags validated on two processes give the same valid and invalid bags,
+    in the same order, as bags validated one after another"""
+    main_bag, _ = bags
+    bag_paths = [main_bag]
+    for name in ('222222', '333333', '444444'):
+        bag_paths.append(tmp_path / 'main' / name)
+        shutil.copytree(main_bag, bag_paths[-1])
+    bag_paths[1].joinpath('data', 'file.txt').unlink()
+    bag_paths[2].joinpath('data', 'file.txt').write_bytes(b'SOME bytes for the payload')
+
+    serial = compare_bags.validate_bags_in_main(bag_paths, workers=1, fixity=fixity)
+    parallel = compare_bags.validate_bags_in_main(bag_paths, workers=2, fixity=fixity)
+
+    assert serial == parallel
+    invalid = ['222222', '333333'] if fixity else ['222222']
+    assert serial[1] == invalid
+    assert list(serial[0]) == [p.name for p in bag_paths if p.name not in invalid]
+
+def test_dedup_refuses_unreadable_payload(tmp_path, bags, unreadable):
+    """A duplicate whose payload cannot all be listed is left alone"""
+    main_bag, dup_bag = bags
+    unreadable(dup_bag / 'data' / 'sub')
+    dedup = compare_bags.BagDedup('hardlink')
+
+    assert dedup(main_bag, dup_bag) is None
+    assert dedup.reclaimed == 0
+
+def test_audit_main_records_folder_that_is_not_a_bag(tmp_path, bags):
+    """A six-digit folder without bagit.txt is invalid, and the audit goes on"""
+    tmp_path.joinpath('main', '222222').mkdir()
+    report = tmp_path / 'audit.jsonl'
+    args = argparse.Namespace(directory_main=str(tmp_path / 'main'), bag_index=None,
+                              scan_workers=1, audit=str(tmp_path / 'audit.sqlite'),
+                              throttle=None, report=str(report), workers=1)
+
+    compare_bags.audit_main(args)
+
+    results = {r['bag']: r for r in map(json.loads, report.read_text().splitlines())}
+    assert results['123456']['status'] == 'valid'
+    assert results['222222']['status'] == 'invalid'
+    assert results['222222']['error'].startswith('not a bag')
+
+def test_find_duplicates_skips_folders_that_are_not_bags(monkeypatch, tmp_path, bags, capsys):
+    """Six-digit folders without bagit.txt, in the main or the dupe
+    directory, are skipped and the other bags are still matched"""
+    tmp_path.joinpath('main', '222222').mkdir()
+    tmp_path.joinpath('dupe', '333333').mkdir()
+    monkeypatch.setattr('sys.argv', ['compare_bags.py', '-d_dupe', str(tmp_path / 'dupe'),
+                                     '-d_main', str(tmp_path / 'main'), '--find_duplicates'])
+
+    compare_bags.main()
+
+    assert "of the bag with the same ID ['123456']" in capsys.readouterr().out
+
+def make_bag(folder: Path, files: dict) -> Path:
+    folder.mkdir(parents=True)
+    for name, content in files.items():
+        folder.joinpath(name).parent.mkdir(parents=True, exist_ok=True)
+        folder.joinpath(name).write_bytes(content)
+    bagit.make_bag(str(folder), checksums=['md5'])
+    return folder
+
+def content_duplicates(tmp_path: Path, dupes: dict) -> dict:
+    main_bags = sorted(tmp_path.joinpath('main').iterdir())
+    by_checksum, file_counts = compare_bags.index_payload_checksums(main_bags)
+    dup_bags = [make_bag(tmp_path / 'dupe' / bag, files) for bag, files in dupes.items()]
+    return {r['bag']: r for r in
+            compare_bags.find_content_duplicates(by_checksum, file_counts, dup_bags)}
+
+MAIN_FILES = {'a.txt': b'a bytes', 'sub/b.txt': b'b bytes'}
+
+def test_content_duplicates_statuses(tmp_path):
+    """A duplicate is full or renamed when it holds exactly the files of one
+    main bag, partial when only some match, and unique when none do"""
+    make_bag(tmp_path / 'main' / '123456', MAIN_FILES)
+
+    results = content_duplicates(tmp_path, {
+        '123456': {'moved/a.txt': b'a bytes', 'sub/b.txt': b'b bytes'},
+        '111111': MAIN_FILES,
+        '222222': {'a.txt': b'a bytes', 'c.txt': b'new bytes'},
+        '333333': {'a.txt': b'a bytes'},
+        '444444': {'c.txt': b'new bytes'},
+    })
+
+    assert {bag: r['status'] for bag, r in results.items()} == {
+        '123456': 'full', '111111': 'renamed', '222222': 'partial',
+        '333333': 'partial', '444444': 'unique'}
+    assert results['123456']['moved'] == ['data/moved/a.txt']
+    assert results['111111']['main_bag'] == '123456'
+    assert results['222222']['not_found'] == ['data/c.txt']
+    assert (results['333333']['matched'], results['333333']['files']) == (1, 1)
+    assert results['444444']['main_bag'] == ''
+
+def test_content_duplicates_tie_goes_to_same_id(tmp_path):
+    """When two main bags hold the same files, the one with the duplicate's
+    ID is the match, whichever sorts first"""
+    make_bag(tmp_path / 'main' / '123456', MAIN_FILES)
+    make_bag(tmp_path / 'main' / '654321', MAIN_FILES)
+
+    results = content_duplicates(tmp_path, {'123456': MAIN_FILES, '654321': MAIN_FILES})
+
+    assert results['123456']['main_bag'] == '123456'
+    assert results['654321']['main_bag'] == '654321'
+    assert results['123456']['status'] == results['654321']['status'] == 'full'
@@ -0,0 +1,106 @@
+import os
+import pytest
+from pathlib import Path
+
+import compare_paths
+
+@pytest.fixture
+def tree(tmp_path: Path):
+    """An M### folder with a file, a symlink to it and a broken symlink"""
+    folder = tmp_path.joinpath('M1234', 'sub')
+    folder.mkdir(parents=True)
+    folder.joinpath('file.txt').write_bytes(b'some bytes')
+    folder.joinpath('link.txt').symlink_to(folder / 'file.txt')
+    folder.joinpath('broken').symlink_to(tmp_path / 'nothing')
+    return tmp_path.joinpath('M1234')
+
+def test_snapshot_skips_broken_symlink(tmp_path, tree):
+    """A broken symlink is left out of the snapshot, and the rest is written"""
+    snapshot = tmp_path / 'snapshot.sqlite'
+    compare_paths.write_snapshot(tree, snapshot, workers=2)
+
+    difference, mismatch_ls = compare_paths.compare_to_snapshot(tree, snapshot, workers=2)
+
+    assert difference == set()
+    assert mismatch_ls == []
+
+def test_snapshot_skips_special_file(tmp_path, tree):
+    """Pipes are neither folders nor regular files, so they are not hashed"""
+    os.mkfifo(tree / 'sub' / 'pipe')
+    snapshot = tmp_path / 'snapshot.sqlite'
+    compare_paths.write_snapshot(tree, snapshot)
+
+    stats, _ = compare_paths.snapshot_paths(tree)
+
+    assert sorted(stats) == ['M1234/sub', 'M1234/sub/file.txt', 'M1234/sub/link.txt']
+
+def test_snapshot_finds_changed_file(tmp_path, tree):
+    """A file written after the snapshot is a mismatch"""
+    snapshot = tmp_path / 'snapshot.sqlite'
+    compare_paths.write_snapshot(tree, snapshot)
+    tree.joinpath('sub', 'file.txt').write_bytes(b'SOME BYTES')
+    os.utime(tree / 'sub' / 'file.txt', ns=(0, 0))
+
+    difference, mismatch_ls = compare_paths.compare_to_snapshot(tree, snapshot)
+
+    assert difference == set()
+    assert sorted(mismatch_ls) == ['M1234/sub/file.txt', 'M1234/sub/link.txt']
+
+def test_find_all_paths_skips_unreadable_folder(tree, unreadable):
+    """A folder that cannot be listed is skipped, like Path.rglob does,
+    and the rest of the tree is still found"""
+    tree.joinpath('other').mkdir()
+    tree.joinpath('other', 'file.txt').write_bytes(b'other bytes')
+    unreadable(tree / 'sub')
+
+    path_set, parent = compare_paths.find_all_paths(tree, scan_workers=2)
+
+    assert path_set == {'M1234/sub', 'M1234/other', 'M1234/other/file.txt'}
+    assert parent == tree.parent
+
+@pytest.fixture
+def copies(tmp_path: Path):
+    """Two copies of an M### folder whose file has the same size and
+    modification time but different bytes"""
+    for name, content in (('one', b'some bytes'), ('two', b'SOME BYTES')):
+        folder = tmp_path.joinpath(name, 'M1234', 'sub')
+        folder.mkdir(parents=True)
+        folder.joinpath('file.txt').write_bytes(content)
+        folder.joinpath('same.txt').write_bytes(b'same bytes')
+        for file in folder.iterdir():
+            os.utime(file, ns=(0, 0))
+    return tmp_path / 'one' / 'M1234', tmp_path / 'two' / 'M1234'
+
+def test_same_content(tmp_path):
+    """Files are the same only when every byte is, whatever the chunk size"""
+    paths = {name: tmp_path / name for name in ('a', 'b', 'c', 'd')}
+    paths['a'].write_bytes(b'0123456789')
+    paths['b'].write_bytes(b'0123456789')
+    paths['c'].write_bytes(b'0123456780')
+    paths['d'].write_bytes(b'012345678')
+
+    assert compare_paths.same_content(paths['a'], paths['b'], chunk_size=3)
+    assert not compare_paths.same_content(paths['a'], paths['c'], chunk_size=3)
+    assert not compare_paths.same_content(paths['a'], paths['d'], chunk_size=3)
+
+def test_find_content_mismatches(copies):
+    """Only files whose bytes differ are mismatches; folders are not compared"""
+    dir_one, dir_two = copies
+    items, _ = compare_paths.find_all_paths(dir_one)
+
+    mismatch_ls = compare_paths.find_content_mismatches(items, dir_one.parent, dir_two.parent,
+                                                        workers=2, chunk_size=4)
+
+    assert mismatch_ls == ['M1234/sub/file.txt']
+
+@pytest.mark.parametrize('content', [True, False])
+def test_main_content(monkeypatch, caplog, copies, content):
+    """With the same size and modification time, only --content finds the
+    different bytes; the default comparison only looks at os.stat"""
+    dir_one, dir_two = copies
+    argv = ['compare_paths.py', '-d_one', str(dir_one), '-d_two', str(dir_two)]
+    monkeypatch.setattr('sys.argv', argv + ['--content'] * content)
+
+    compare_paths.main()
+
+    assert ("Mismatch: ['M1234/sub/file.txt']" in caplog.text) == content
@@ -0,0 +1,82 @@
+import os
+import shutil
+import bagit
+import pytest
+from pathlib import Path
+
+import compare_bags
+import manifest_store
+
+@pytest.fixture
+def bag_pair(tmp_path: Path):
+    """A main bag and a duplicate with a missing, an extra and a changed file"""
+    main_bag = tmp_path.joinpath('main', '123456')
+    main_bag.joinpath('sub').mkdir(parents=True)
+    for name in ['a.txt', 'b.txt', 'sub/c.txt', 'sub/d.txt']:
+        main_bag.joinpath(name).write_bytes(f'bytes of {name}'.encode())
+    dup_bag = tmp_path.joinpath('dupe', '123456')
+    shutil.copytree(main_bag, dup_bag)
+    bagit.make_bag(str(main_bag), checksums=['sha256'])
+
+    dup_bag.joinpath('b.txt').unlink()
+    dup_bag.joinpath('sub', 'e.txt').write_bytes(b'only in the duplicate')
+    dup_bag.joinpath('sub', 'c.txt').write_bytes(b'changed')
+    bagit.make_bag(str(dup_bag), checksums=['sha256'])
+    return main_bag, dup_bag
+
+def test_diff_stores_matches_manifest_entries(tmp_path, bag_pair):
+    """Merging two stores finds the same differences as comparing the
+    payload entries bagit loads"""
+    main_bag, dup_bag = bag_pair
+    expected = compare_bags.compare_manifest_entries(
+        bagit.Bag(str(main_bag)).payload_entries(), bagit.Bag(str(dup_bag)).payload_entries())
+
+    result = compare_bags.compare_manifest_stores(main_bag, dup_bag, 'sha256', tmp_path / 'stores')
+
+    assert result == expected == {'missing': ['data/b.txt'], 'extra': ['data/sub/e.txt'],
+                                  'mismatched': ['data/sub/c.txt']}
+
+def test_diff_stores_identical(tmp_path, bag_pair):
+    """A bag compared with its own copy has no differences"""
+    main_bag, _ = bag_pair
+    copy = tmp_path.joinpath('copy', '123456')
+    shutil.copytree(main_bag, copy)
+
+    with manifest_store.open_store(main_bag, 'sha256', tmp_path / 'stores') as main, \
+            manifest_store.open_store(copy, 'sha256', tmp_path / 'stores') as dup:
+        assert main.same_entries(dup)
+        assert list(manifest_store.diff_stores(main, dup)) == []
+
+def test_changed_manifest_rebuilds_store(tmp_path, bag_pair):
+    """A store is rebuilt when its manifest is written to, not reused"""
+    main_bag, _ = bag_pair
+    store_dir = tmp_path / 'stores'
+    with manifest_store.open_store(main_bag, 'sha256', store_dir) as store:
+        before = [store.path(i) for i in range(len(store))]
+
+    manifest = main_bag / 'manifest-sha256.txt'
+    with open(manifest, 'a', encoding='utf-8') as f:
+        f.write(f'{"0" * 64}  data/sub/z.txt\n')
+    st = os.stat(manifest)
+    os.utime(manifest, ns=(st.st_atime_ns, st.st_mtime_ns + 1))
+
+    with manifest_store.open_store(main_bag, 'sha256', store_dir) as store:
+        after = [store.path(i) for i in range(len(store))]
+
+    assert after == before + [b'data/sub/z.txt']
+    assert len(list(store_dir.iterdir())) == 1
+
+def test_compare_bags_by_manifest_with_and_without_stores(tmp_path, bag_pair):
+    """Bags compare the same whether their manifests are loaded or merged
+    from stores, and the main bag is kept by path"""
+    main_bag, dup_bag = bag_pair
+    valid_in_main, invalid_in_main = compare_bags.validate_bags_in_main([main_bag])
+
+    loaded = list(compare_bags.compare_bags_by_manifest(valid_in_main, [dup_bag]))
+    merged = list(compare_bags.compare_bags_by_manifest(valid_in_main, [dup_bag],
+                                                        tmp_path / 'stores'))
+
+    assert valid_in_main == {'123456': main_bag} and invalid_in_main == []
+    assert loaded == merged
+    assert merged[0]['status'] == 'different'
+    assert merged[0]['main'] == str(main_bag)
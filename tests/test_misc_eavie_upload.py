@@ -0,0 +1,240 @@
+import argparse
+import hashlib
+import json
+import pytest
+from pathlib import Path
+
+moto = pytest.importorskip('moto')
+import boto3
+from boto3.exceptions import S3UploadFailedError
+
+import misc_eavie_upload
+
+@pytest.fixture
+def s3(monkeypatch):
+    """A mocked S3 with the service copy bucket, and no waiting between retries"""
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    monkeypatch.setattr(misc_eavie_upload.time, 'sleep', lambda seconds: None)
+    with moto.mock_aws():
+        client = boto3.client('s3')
+        client.create_bucket(Bucket=misc_eavie_upload.BUCKET)
+        yield client
+
+@pytest.fixture
+def media(tmp_path: Path):
+    files = []
+    for i in range(3):
+        filepath = tmp_path.joinpath(f'mym_12345{i}_v01_sc.mp4')
+        filepath.write_bytes(f'media bytes {i}'.encode())
+        files.append(filepath)
+    return files
+
+def bucket_keys(s3) -> set:
+    response = s3.list_objects_v2(Bucket=misc_eavie_upload.BUCKET)
+    return {item['Key'] for item in response.get('Contents', [])}
+
+class FlakyClient:
+    """An S3 client whose first upload of each key fails"""
+    def __init__(self, client):
+        self.client = client
+        self.failed = set()
+
+    def upload_file(self, filename, bucket, key, **kwargs):
+        if key not in self.failed:
+            self.failed.add(key)
+            raise S3UploadFailedError(f'Failed to upload {filename}: connection reset')
+        return self.client.upload_file(filename, bucket, key, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+def test_upload_files(s3, media):
+    """Every file is uploaded under its name, with the ETag of its bytes"""
+    results = misc_eavie_upload.upload_files(media, uploads=2)
+
+    assert bucket_keys(s3) == {f.name for f in media}
+    assert [r['status'] for r in results] == ['uploaded'] * 3
+    assert [r['etag'] for r in results] == [hashlib.md5(f.read_bytes()).hexdigest() for f in media]
+    assert [r['attempts'] for r in results] == [1, 1, 1]
+
+def test_upload_files_retries(monkeypatch, s3, media):
+    """A failed upload is tried again, and succeeds on the second attempt"""
+    make_s3_client = misc_eavie_upload.make_s3_client
+    monkeypatch.setattr(misc_eavie_upload, 'make_s3_client',
+                        lambda *args: FlakyClient(make_s3_client(*args)))
+
+    results = misc_eavie_upload.upload_files(media, retries=2)
+
+    assert bucket_keys(s3) == {f.name for f in media}
+    assert [(r['status'], r['attempts'], r['error']) for r in results] == \
+        [('uploaded', 2, None)] * 3
+
+def test_upload_files_gives_up(s3, media):
+    """An upload that keeps failing is reported as failed after every retry"""
+    s3.delete_bucket(Bucket=misc_eavie_upload.BUCKET)
+
+    results = misc_eavie_upload.upload_files(media[:1], retries=2)
+
+    assert results[0]['status'] == 'failed'
+    assert results[0]['attempts'] == 3
+    assert 'NoSuchBucket' in results[0]['error']
+
+def test_upload_and_report_failed_file(tmp_path, s3, media):
+    """A file gone before its upload fails on its own; the others are
+    uploaded and the report lists every file"""
+    media[1].unlink()
+    report = tmp_path / 'report.jsonl'
+    args = argparse.Namespace(endpoint_url=None, uploads=2, multipart_chunksize=64,
+                              multipart_concurrency=4, retries=3, upload_report=report)
+    journal = misc_eavie_upload.Journal(tmp_path / 'journal.jsonl')
+
+    misc_eavie_upload.upload_and_report(media, args, journal)
+    journal.close()
+
+    results = [json.loads(line) for line in report.read_text().splitlines()]
+    assert [r['status'] for r in results] == ['uploaded', 'failed', 'uploaded']
+    assert results[1]['attempts'] == 0 and 'No such file' in results[1]['error']
+    assert bucket_keys(s3) == {media[0].name, media[2].name}
+    journal = misc_eavie_upload.Journal(tmp_path / 'journal.jsonl')
+    assert journal.is_complete(media[0]) and not journal.is_complete(media[1])
+    journal.close()
+
+def test_absent_in_bucket_with_keys(tmp_path, s3):
+    """With a listed key set, a flac or wav counts as present when its mp4
+    service copy is in the bucket"""
+    s3.put_object(Bucket=misc_eavie_upload.BUCKET, Key='mym_123456_v01_sc.mp4', Body=b'mp4')
+    s3.put_object(Bucket=misc_eavie_upload.BUCKET, Key='mym_123456_v01_sc.json', Body=b'{}')
+    keys = misc_eavie_upload.list_bucket_keys()
+    paths = [tmp_path / name for name in
+             ['mym_123456_v01_sc.mp4', 'mym_123456_v01_sc.json', 'mym_123456_v01_sc.flac',
+              'mym_123456_v01_sc.wav', 'mym_654321_v01_sc.wav', 'mym_654321_v01_sc.json']]
+
+    absent = [misc_eavie_upload.absent_in_bucket(p, keys) for p in paths]
+
+    assert absent == ['', '', '', '', paths[4], paths[5]]
+
+def test_list_bucket_keys_follows_pages(s3):
+    """Every key is listed, past the 1000 keys of one page"""
+    keys = {f'mym_{n:06d}_v01_sc.mp4' for n in range(1005)}
+    for key in keys:
+        s3.put_object(Bucket=misc_eavie_upload.BUCKET, Key=key, Body=b'')
+
+    assert misc_eavie_upload.list_bucket_keys() == keys
+
+def test_list_bucket_keys_endpoint_url(monkeypatch, s3):
+    """The listing goes to the given endpoint, e.g. a local MinIO"""
+    endpoints = []
+    make_s3_client = misc_eavie_upload.make_s3_client
+    monkeypatch.setattr(misc_eavie_upload, 'make_s3_client',
+                        lambda endpoint_url=None, *args: endpoints.append(endpoint_url) or
+                        make_s3_client(None, *args))
+
+    misc_eavie_upload.list_bucket_keys('http://localhost:9000')
+
+    assert endpoints == ['http://localhost:9000']
+
+def test_in_bucket_without_keys(s3):
+    """Without a key set, each key is checked with head_object"""
+    s3.put_object(Bucket=misc_eavie_upload.BUCKET, Key='mym_123456_v01_sc.mp4', Body=b'mp4')
+
+    assert misc_eavie_upload.in_bucket('mym_123456_v01_sc.mp4')
+    assert not misc_eavie_upload.in_bucket('mym_654321_v01_sc.mp4')
+
+def touch(folder: Path, names: list) -> list:
+    filepaths = [folder / name for name in names]
+    for filepath in filepaths:
+        filepath.write_bytes(b'')
+    return filepaths
+
+def test_pair_ami_files(tmp_path):
+    """Media and JSON sharing a stem are paired under their ID; anything
+    that cannot be paired to one ID is sorted into its orphan category"""
+    filepaths = touch(tmp_path, ['mym_123456_v01_sc.mp4', 'mym_123456_v01_sc.json',
+                                 'mym_234567_v01_sc.wav', 'mym_234567_v01_sc.json',
+                                 'mym_234567_v02_sc.flac', 'mym_234567_v02_sc.json',
+                                 'mym_345678_v01_sc.mp4',
+                                 'mym_456789_v01_sc.json',
+                                 'mym_noid_v01_sc.mp4', 'mym_noid_v01_sc.json',
+                                 'notes.txt'])
+
+    ami_dict, orphans = misc_eavie_upload.pair_ami_files(filepaths)
+
+    assert ami_dict == {'123456': [tmp_path / 'mym_123456_v01_sc.mp4',
+                                   tmp_path / 'mym_123456_v01_sc.json']}
+    assert orphans == {
+        'media_without_json': [str(tmp_path / 'mym_345678_v01_sc.mp4')],
+        'json_without_media': [str(tmp_path / 'mym_456789_v01_sc.json')],
+        'media_without_id': [str(tmp_path / 'mym_noid_v01_sc.mp4')],
+        'duplicate_ids': {'234567': [str(tmp_path / 'mym_234567_v01_sc.wav'),
+                                     str(tmp_path / 'mym_234567_v02_sc.flac')]}
+    }
+
+def ami_item(folder: Path, stem: str, data) -> tuple:
+    media_p, json_p = touch(folder, [f'{stem}.mp4', f'{stem}.json'])
+    json_p.write_text(data if isinstance(data, str) else json.dumps(data), encoding='utf-8')
+    return media_p, json_p
+
+@pytest.mark.parametrize('stem, data, failed', [
+    ('mym_123456_v01_sc', {'asset': {'referenceFilename': 'mym_123456_v01_sc.mp4'},
+                           'bibliographic': {'barcode': '33433000000001'}}, []),
+    ('mym_123456_v01', {'asset': {'referenceFilename': 'other.mp4'},
+                        'bibliographic': {'barcode': '12345000000001'}},
+     ['media_filename', 'json_filename', 'json_ref_filename', 'json_barcode']),
+    ('mym_123456_v01_sc', '{"asset": ', ['json_readable']),
+    ('mym_123456_v01_sc', {'asset': {}}, ['json_ref_filename', 'json_barcode']),
+    ('mym_123456_v01_sc', [], ['json_ref_filename', 'json_barcode']),
+])
+def test_validate_item(tmp_path, stem, data, failed):
+    """Every rule runs, and the report lists each rule the item failed,
+    including JSON that cannot be parsed or lacks a field"""
+    media_p, json_p = ami_item(tmp_path, stem, data)
+
+    result = misc_eavie_upload.validate_item('123456', media_p, json_p)
+
+    assert result == {'id': '123456', 'media': str(media_p), 'json': str(json_p),
+                      'valid': not failed, 'failed': failed}
+
+@pytest.fixture
+def ami_dir(tmp_path: Path) -> Path:
+    """A folder of two valid items, media and JSON"""
+    folder = tmp_path / 'ami'
+    folder.mkdir()
+    for stem in ('mym_123456_v01_sc', 'mym_234567_v01_sc'):
+        ami_item(folder, stem, {'asset': {'referenceFilename': f'{stem}.mp4'},
+                                'bibliographic': {'barcode': '33433000000001'}})
+    return folder
+
+def test_journal_rerun_skips_completed_items(monkeypatch, tmp_path, s3, ami_dir):
+    """A rerun with the same journal skips the uploaded items without listing
+    the bucket; an item changed since is checked against the bucket again"""
+    journal = tmp_path / 'journal.jsonl'
+    argv = ['misc_eavie_upload.py', '-d', str(ami_dir), '--check_and_upload',
+            '--journal', str(journal)]
+    monkeypatch.setattr('sys.argv', argv)
+    list_bucket_keys = misc_eavie_upload.list_bucket_keys
+    listings = []
+    monkeypatch.setattr(misc_eavie_upload, 'list_bucket_keys',
+                        lambda *args: listings.append(args) or list_bucket_keys(*args))
+    uploads = []
+    upload_files = misc_eavie_upload.upload_files
+    monkeypatch.setattr(misc_eavie_upload, 'upload_files',
+                        lambda filepaths, *args: uploads.append(sorted(p.name for p in filepaths))
+                        or upload_files(filepaths, *args))
+
+    misc_eavie_upload.main()
+    misc_eavie_upload.main()
+
+    assert len(listings) == 1
+    assert len(uploads) == 1
+    assert bucket_keys(s3) == {p.name for p in ami_dir.iterdir()}
+
+    ami_dir.joinpath('mym_234567_v01_sc.mp4').write_bytes(b'new media bytes')
+    misc_eavie_upload.main()
+
+    assert len(listings) == 2
+    assert len(uploads) == 1
+    records = [json.loads(line) for line in journal.read_text().splitlines()]
+    assert [(Path(r['file']).name, r['state']) for r in records[-2:]] == [
+        ('mym_234567_v01_sc.mp4', 'present'), ('mym_234567_v01_sc.json', 'present')]